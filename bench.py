@@ -0,0 +1,906 @@
+"""Benchmark di carico per l'app ForCreators.
+
+Esegue flussi realistici contro l'app FastAPI in-process (httpx ASGITransport)
+oppure contro un uvicorn già avviato, e riporta throughput e p50/p95/p99 per
+rotta. I risultati si possono salvare come baseline JSON e confrontare: una
+regressione oltre la tolleranza fa uscire con codice 1.
+
+Con --startup misura invece l'avvio a freddo: ogni run è un processo nuovo
+che importa main, entra nel lifespan e serve una prima richiesta. I budget
+(--budget-*-ms) si applicano alla mediana; se superati esce con codice 1.
+
+Con --contact-writes N misura il throughput di N POST /api/contact con
+--concurrency richieste in parallelo, in un processo nuovo per ciascuna
+configurazione (prima: journal DELETE senza group commit; poi WAL, group
+commit, synchronous NORMAL). Ogni configurazione usa un DB SQLite nuovo,
+salvo --database-url.
+
+Con --logins esegue solo login concorrenti (hash password sul pool di
+processi) e in parallelo una sonda su /metrics: la sua latenza mostra se
+l'event loop resta libero. Risultato e baseline come nel run normale; i 503
+del pool saturo contano come errori.
+
+Con --serialization misura solo la serializzazione per richiesta (µs/op) di
+/api/user, /api/media-kit, /api/profile-tips e /api/dashboard: prima
+(jsonable_encoder + json della stdlib), con response_model Pydantic, e ora
+(orjson e frammenti già codificati).
+
+Con --stripe-reconcile N crea N utenti, 1 su 4 fuori sync con Stripe
+(checkout o cancellazione persi, upgrade), e fa girare la riconciliazione
+contro uno stub locale di Stripe (latenza e limite di richieste al secondo
+configurabili, 429 oltre il limite): prima in dry run con più configurazioni
+di concorrenza, poi applicata, poi un secondo giro che deve risultare vuoto.
+Esce con 1 se lo stato finale di users o user_stats non è quello atteso.
+
+Esempi:
+    python bench.py --database-url sqlite:///./bench.db --save-baseline baselines/sqlite.json
+    python bench.py --database-url postgresql://localhost/forcreators --check-baseline baselines/pg.json
+    python bench.py --base-url http://127.0.0.1:8000 --concurrency 50 --iterations 20
+    python bench.py --startup --startup-runs 7 --budget-import-ms 1500 --budget-cold-start-ms 2500
+    python bench.py --contact-writes 2000 --concurrency 50
+    python bench.py --logins --concurrency 32 --iterations 5 --database-url sqlite:///./bench-login.db
+    python bench.py --serialization --serialization-iterations 20000
+    python bench.py --stripe-reconcile 5000 --stripe-latency-ms 200 --stripe-rps 25
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+BENCH_WEBHOOK_SECRET = "whsec_bench"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    async def call(self, client: httpx.AsyncClient, method: str, route: str, url: str, **kwargs: Any) -> httpx.Response:
+        key = f"{method} {route}"
+        t0 = time.perf_counter()
+        r = await client.request(method, url, **kwargs)
+        self.samples.setdefault(key, []).append((time.perf_counter() - t0) * 1000.0)
+        if r.status_code >= 500:
+            self.errors[key] = self.errors.get(key, 0) + 1
+        return r
+
+    def report(self, wall_seconds: float) -> Dict[str, Any]:
+        routes = {}
+        for key, values in sorted(self.samples.items()):
+            routes[key] = {
+                "count": len(values),
+                "errors": self.errors.get(key, 0),
+                "rps": round(len(values) / wall_seconds, 2) if wall_seconds else 0.0,
+                "mean_ms": round(statistics.fmean(values), 3),
+                "p50_ms": round(percentile(values, 50), 3),
+                "p95_ms": round(percentile(values, 95), 3),
+                "p99_ms": round(percentile(values, 99), 3),
+            }
+        total = sum(len(v) for v in self.samples.values())
+        return {
+            "wall_seconds": round(wall_seconds, 3),
+            "total_requests": total,
+            "throughput_rps": round(total / wall_seconds, 2) if wall_seconds else 0.0,
+            "routes": routes,
+        }
+
+
+def sign_stripe_payload(body: str, secret: str) -> str:
+    ts = int(time.time())
+    sig = hmac.new(secret.encode(), f"{ts}.{body}".encode(), hashlib.sha256).hexdigest()
+    return f"t={ts},v1={sig}"
+
+
+# =======================
+# FLUSSI
+# =======================
+async def flow_dashboard(client: httpx.AsyncClient, rec: Recorder, followers: int) -> Optional[str]:
+    email = f"bench-{uuid.uuid4().hex}@example.com"
+    r = await rec.call(client, "POST", "/api/signup", "/api/signup", json={
+        "email": email,
+        "password": "bench-password",
+        "main_platform": "instagram",
+        "username": email.split("@")[0],
+        "followers": followers,
+        "profiles_count": 1,
+    })
+    if r.status_code != 200:
+        return None
+    user_id = r.json()["user_id"]
+    params = {"user_id": user_id}
+    await rec.call(client, "GET", "/api/user", "/api/user", params=params)
+    await rec.call(client, "GET", "/api/media-kit", "/api/media-kit", params=params)
+    await rec.call(client, "GET", "/api/profile-tips", "/api/profile-tips", params=params)
+    return email
+
+
+async def flow_returning(client: httpx.AsyncClient, rec: Recorder, email: str) -> None:
+    r = await rec.call(client, "POST", "/api/login", "/api/login", json={"email": email, "password": "bench-password"})
+    if r.status_code != 200:
+        return
+    params = {"user_id": r.json()["user_id"]}
+    await rec.call(client, "GET", "/api/user", "/api/user", params=params)
+    await rec.call(client, "GET", "/api/media-kit", "/api/media-kit", params=params)
+
+
+async def flow_contact(client: httpx.AsyncClient, rec: Recorder) -> None:
+    await rec.call(client, "POST", "/api/contact", "/api/contact", json={
+        "name": "Bench",
+        "email": "bench@example.com",
+        "subject": "Benchmark",
+        "message": "Messaggio di prova generato dal benchmark.",
+    })
+
+
+async def flow_stripe_webhook(client: httpx.AsyncClient, rec: Recorder, email: str, secret: str) -> None:
+    event_id = f"evt_bench_{uuid.uuid4().hex}"
+    body = json.dumps({
+        "id": event_id,
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": f"cs_bench_{uuid.uuid4().hex}",
+            "customer_email": email,
+            "customer": f"cus_bench_{uuid.uuid4().hex[:12]}",
+            "amount_total": 490,
+        }},
+    })
+    headers = {"stripe-signature": sign_stripe_payload(body, secret), "content-type": "application/json"}
+    await rec.call(client, "POST", "/stripe/webhook", "/stripe/webhook", content=body, headers=headers)
+    # replay: Stripe ritenta lo stesso evento
+    headers = {"stripe-signature": sign_stripe_payload(body, secret), "content-type": "application/json"}
+    await rec.call(client, "POST", "/stripe/webhook", "/stripe/webhook", content=body, headers=headers)
+
+
+async def flow_pages(client: httpx.AsyncClient, rec: Recorder) -> None:
+    await rec.call(client, "GET", "/", "/")
+    await rec.call(client, "GET", "/pricing", "/pricing")
+
+
+async def virtual_user(client: httpx.AsyncClient, rec: Recorder, iterations: int, webhook_secret: Optional[str], seed: int) -> None:
+    for i in range(iterations):
+        followers = [800, 5_000, 50_000, 400_000][(seed + i) % 4]
+        email = await flow_dashboard(client, rec, followers)
+        if email:
+            await flow_returning(client, rec, email)
+            if webhook_secret:
+                await flow_stripe_webhook(client, rec, email, webhook_secret)
+        await flow_contact(client, rec)
+        await flow_pages(client, rec)
+
+
+# =======================
+# TARGET
+# =======================
+def load_app(args: argparse.Namespace) -> Any:
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+    os.environ.setdefault("STRIPE_WEBHOOK_SECRET", BENCH_WEBHOOK_SECRET)
+    # niente rete verso Stripe durante il bench: line_items fallisce subito
+    os.environ.setdefault("STRIPE_API_BASE", "http://127.0.0.1:9")
+    os.environ.setdefault("STRIPE_RECONCILE_INTERVAL_MINUTES", "0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    return main
+
+
+@asynccontextmanager
+async def in_process_client(args: argparse.Namespace):
+    main = load_app(args)
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            yield client, os.environ["STRIPE_WEBHOOK_SECRET"]
+
+
+@asynccontextmanager
+async def remote_client(args: argparse.Namespace):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=30.0) as client:
+        yield client, args.webhook_secret or None
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    target = remote_client(args) if args.base_url else in_process_client(args)
+    async with target as (client, webhook_secret):
+        # warm-up: pagine pre-renderizzate, pool DB, cache
+        await virtual_user(client, Recorder(), 1, webhook_secret, 0)
+
+        rec = Recorder()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(
+            virtual_user(client, rec, args.iterations, webhook_secret, seed)
+            for seed in range(args.concurrency)
+        ))
+        wall = time.perf_counter() - t0
+
+    result = rec.report(wall)
+    result["config"] = {
+        "target": args.base_url or "in-process",
+        "database_url": (args.database_url or os.getenv("DATABASE_URL", "sqlite:///./local.db")).split("@")[-1],
+        "concurrency": args.concurrency,
+        "iterations": args.iterations,
+    }
+    return result
+
+
+async def run_logins(args: argparse.Namespace) -> Dict[str, Any]:
+    """Login concorrenti + una sonda che misura quanto l'event loop resta reattivo."""
+    target = remote_client(args) if args.base_url else in_process_client(args)
+    run_id = uuid.uuid4().hex[:8]
+    emails = [f"login-{run_id}-{i}@bench.example.com" for i in range(min(args.concurrency, 20))]
+    async with target as (client, _):
+        for email in emails:
+            r = await client.post("/api/signup", json={
+                "email": email, "password": "bench-password", "main_platform": "instagram",
+                "username": "bench", "followers": 1000, "profiles_count": 1,
+            })
+            r.raise_for_status()
+
+        rec = Recorder()
+        done = asyncio.Event()
+
+        async def login_user(seed: int) -> None:
+            for i in range(args.iterations):
+                email = emails[(seed + i) % len(emails)]
+                await rec.call(client, "POST", "/api/login", "/api/login",
+                               json={"email": email, "password": "bench-password"})
+
+        async def probe() -> None:
+            # una rotta che non tocca il pool: se l'hash bloccasse il loop si vedrebbe qui
+            while not done.is_set():
+                await rec.call(client, "GET", "/metrics (sonda)", "/metrics")
+                await asyncio.sleep(0.02)
+
+        probe_task = asyncio.create_task(probe())
+        t0 = time.perf_counter()
+        await asyncio.gather(*(login_user(seed) for seed in range(args.concurrency)))
+        wall = time.perf_counter() - t0
+        done.set()
+        await probe_task
+
+    result = rec.report(wall)
+    result["config"] = {
+        "target": args.base_url or "in-process",
+        "database_url": (args.database_url or os.getenv("DATABASE_URL", "sqlite:///./local.db")).split("@")[-1],
+        "concurrency": args.concurrency,
+        "iterations": args.iterations,
+    }
+    return result
+
+
+# =======================
+# AVVIO A FREDDO
+# =======================
+# eseguito in un processo nuovo: i tempi partono da BENCH_T0 (wall clock del
+# padre prima dello spawn), così cold_start_ms include l'avvio dell'interprete
+STARTUP_CHILD = """
+import asyncio, json, os, sys, time
+t_spawn = float(os.environ["BENCH_T0"])
+sys.path.insert(0, os.environ["BENCH_APP_DIR"])
+t0 = time.perf_counter()
+import main
+t_import = time.perf_counter()
+import httpx
+
+async def first_request():
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        t_ready = time.perf_counter()
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            r = await client.get(os.environ["BENCH_STARTUP_PATH"])
+        t_first = time.perf_counter()
+        cold = (time.time() - t_spawn) * 1000.0
+        print("BENCH_RESULT " + json.dumps({
+            "status": r.status_code,
+            "import_ms": (t_import - t0) * 1000.0,
+            "lifespan_ms": (t_ready - t_import) * 1000.0,
+            "first_request_ms": (t_first - t_ready) * 1000.0,
+            "cold_start_ms": cold,
+        }), flush=True)
+
+asyncio.run(first_request())
+"""
+
+STARTUP_METRICS = ("import_ms", "lifespan_ms", "first_request_ms", "cold_start_ms")
+
+def run_startup_once(args: argparse.Namespace) -> Dict[str, Any]:
+    env = dict(os.environ)
+    if args.database_url:
+        env["DATABASE_URL"] = args.database_url
+    env["BENCH_APP_DIR"] = os.path.dirname(os.path.abspath(__file__))
+    env["BENCH_STARTUP_PATH"] = args.startup_path
+    env["BENCH_T0"] = repr(time.time())
+    proc = subprocess.run([sys.executable, "-c", STARTUP_CHILD], env=env, capture_output=True, text=True, timeout=120)
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH_RESULT "):
+            return json.loads(line[len("BENCH_RESULT "):])
+    raise RuntimeError(f"avvio fallito (exit {proc.returncode}):\n{proc.stderr[-2000:]}")
+
+def run_startup(args: argparse.Namespace) -> Dict[str, Any]:
+    # primo run a vuoto: crea/migra il DB, i successivi misurano un avvio normale
+    run_startup_once(args)
+    runs = [run_startup_once(args) for _ in range(max(1, args.startup_runs))]
+    summary = {
+        m: {
+            "median": round(statistics.median(r[m] for r in runs), 1),
+            "max": round(max(r[m] for r in runs), 1),
+        }
+        for m in STARTUP_METRICS
+    }
+    return {
+        "config": {
+            "database_url": (args.database_url or os.getenv("DATABASE_URL", "sqlite:///./local.db")).split("@")[-1],
+            "path": args.startup_path,
+            "runs": len(runs),
+        },
+        "startup": summary,
+        "statuses": sorted({r["status"] for r in runs}),
+    }
+
+def check_startup_budgets(result: Dict[str, Any], args: argparse.Namespace) -> List[str]:
+    problems = []
+    for metric, budget in (
+        ("import_ms", args.budget_import_ms),
+        ("first_request_ms", args.budget_first_request_ms),
+        ("cold_start_ms", args.budget_cold_start_ms),
+    ):
+        median = result["startup"][metric]["median"]
+        if budget and median > budget:
+            problems.append(f"{metric}: mediana {median}ms > budget {budget}ms")
+    return problems
+
+def print_startup_report(result: Dict[str, Any]) -> None:
+    cfg = result["config"]
+    print(f"\navvio a freddo  db={cfg['database_url']}  path={cfg['path']}  runs={cfg['runs']}  status={result['statuses']}")
+    print(f"{'fase':<20}{'mediana':>10}{'max':>10}")
+    for metric, s in result["startup"].items():
+        print(f"{metric:<20}{s['median']:>10.1f}{s['max']:>10.1f}")
+
+
+CONTACT_CHILD = """
+import asyncio, json, os, sys, time
+sys.path.insert(0, os.environ["BENCH_APP_DIR"])
+import main
+import httpx
+from sqlalchemy import func, select
+
+async def write_contacts(n, concurrency):
+    transport = httpx.ASGITransport(app=main.app)
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(n):
+        queue.put_nowait(i)
+
+    async def worker(client):
+        while not queue.empty():
+            i = queue.get_nowait()
+            t0 = time.perf_counter()
+            r = await client.post("/api/contact", json={
+                "name": "Bench", "email": "bench@example.com", "subject": f"Benchmark {i}",
+                "message": "Messaggio di prova generato dal benchmark.",
+            })
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+            assert r.status_code == 200, r.text
+
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.post("/api/contact", json={"name": "w", "email": "w@example.com", "subject": "w", "message": "warmup"})
+            t0 = time.perf_counter()
+            await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+            wall = time.perf_counter() - t0
+        async with main.adb() as s:
+            stored = await s.scalar(select(func.count()).select_from(main.ContactRow))
+    latencies.sort()
+    print("BENCH_RESULT " + json.dumps({
+        "wall_seconds": wall,
+        "latencies": latencies,
+        "stored": stored,
+        "buffer": main.append_buffer.stats,
+    }), flush=True)
+
+asyncio.run(write_contacts(int(os.environ["BENCH_CONTACTS"]), int(os.environ["BENCH_CONCURRENCY"])))
+"""
+
+CONTACT_CONFIGS = (
+    ("prima (DELETE, no group commit)", {"WRITE_BUFFER_ENABLED": "0", "SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL"}),
+    ("WAL", {"WRITE_BUFFER_ENABLED": "0", "SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "FULL"}),
+    ("WAL + group commit", {"WRITE_BUFFER_ENABLED": "1", "SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "FULL"}),
+    ("WAL + group commit + NORMAL", {"WRITE_BUFFER_ENABLED": "1", "SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "NORMAL"}),
+)
+
+def run_contact_writes_once(args: argparse.Namespace, overrides: Dict[str, str], workdir: str, idx: int) -> Dict[str, Any]:
+    env = dict(os.environ)
+    env.update(overrides)
+    env["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, f'contacts{idx}.db')}"
+    env["BENCH_APP_DIR"] = os.path.dirname(os.path.abspath(__file__))
+    env["BENCH_CONTACTS"] = str(args.contact_writes)
+    env["BENCH_CONCURRENCY"] = str(args.concurrency)
+    proc = subprocess.run([sys.executable, "-c", CONTACT_CHILD], env=env, capture_output=True, text=True,
+                          timeout=600, cwd=env["BENCH_APP_DIR"])
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH_RESULT "):
+            return json.loads(line[len("BENCH_RESULT "):])
+    raise RuntimeError(f"benchmark contatti fallito (exit {proc.returncode}):\n{proc.stderr[-2000:]}")
+
+def run_contact_writes(args: argparse.Namespace) -> Dict[str, Any]:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench-contacts-") as workdir:
+        for idx, (name, overrides) in enumerate(CONTACT_CONFIGS):
+            r = run_contact_writes_once(args, overrides, workdir, idx)
+            lat = r["latencies"]
+            batches = r["buffer"]["batches"]
+            results[name] = {
+                "rps": round(len(lat) / r["wall_seconds"], 1),
+                "p50_ms": round(percentile(lat, 50), 2),
+                "p95_ms": round(percentile(lat, 95), 2),
+                "p99_ms": round(percentile(lat, 99), 2),
+                "stored": r["stored"],
+                "avg_batch": round(r["buffer"]["items"] / batches, 1) if batches else 1.0,
+            }
+    return {
+        "config": {
+            "database_url": (args.database_url or "sqlite (file temporaneo)").split("@")[-1],
+            "contacts": args.contact_writes,
+            "concurrency": args.concurrency,
+        },
+        "contact_writes": results,
+    }
+
+def print_contact_writes_report(result: Dict[str, Any]) -> None:
+    cfg = result["config"]
+    print(f"\nscritture contatti  db={cfg['database_url']}  contatti={cfg['contacts']}  concurrency={cfg['concurrency']}")
+    print(f"{'configurazione':<32}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'batch':>8}")
+    for name, s in result["contact_writes"].items():
+        print(f"{name:<32}{s['rps']:>9.1f}{s['p50_ms']:>9.2f}{s['p95_ms']:>9.2f}{s['p99_ms']:>9.2f}{s['avg_batch']:>8.1f}")
+
+
+# =======================
+# SERIALIZZAZIONE
+# =======================
+def time_per_op(fn: Any, items: List[Any], iterations: int) -> float:
+    """µs per chiamata, miglior tempo su 3 giri."""
+    best = float("inf")
+    for _ in range(3):
+        t0 = time.perf_counter()
+        for i in range(iterations):
+            fn(items[i % len(items)])
+        best = min(best, time.perf_counter() - t0)
+    return best / iterations * 1e6
+
+def run_serialization(args: argparse.Namespace) -> Dict[str, Any]:
+    main = load_app(args)
+    from fastapi.encoders import jsonable_encoder
+    from pydantic import TypeAdapter
+    from starlette.responses import JSONResponse
+
+    # righe in memoria (niente DB): tutti i segmenti, piani bloccati e non
+    users = [
+        main.UserRow(
+            user_id=str(uuid.uuid4()), email=f"ser{i}@bench.example.com", password="x",
+            main_platform=platform, username=f"creator_{i}", followers=followers, profiles_count=profiles,
+            segment=main.compute_segment(followers, profiles), plan_key=None,
+            is_premium=paid != "free", paid_plan=paid,
+        )
+        for i, (followers, profiles, platform, paid) in enumerate([
+            (800, 1, "instagram", "free"), (5_000, 1, "tiktok", "emerging"), (50_000, 1, "youtube", "free"),
+            (120_000, 1, "instagram", "pro"), (400_000, 3, "twitch", "agency"), (900_000, 6, "youtube", "free"),
+        ])
+    ]
+    kits = [main.build_media_kit_payload(u) for u in users]
+    tips = [main.compute_profile_tips(u) for u in users]
+    dashboards = [main.build_dashboard(u) for u in users]
+    adapters = {name: TypeAdapter(model) for name, model in (
+        ("user", main.UserOut), ("media_kit", main.MediaKitOut), ("profile_tips", main.ProfileTipsOut),
+    )}
+
+    def stdlib(fn: Any) -> Any:
+        # stesso codice con encode_json sulla stdlib (come prima di orjson)
+        def run(item: Any) -> Any:
+            saved, main.orjson = main.orjson, None
+            try:
+                return fn(item)
+            finally:
+                main.orjson = saved
+        return run
+
+    def via_model(name: str) -> Any:
+        adapter = adapters[name]
+        return lambda payload: adapter.dump_json(adapter.validate_python(payload))
+
+    n = args.serialization_iterations
+    cases = {
+        "/api/user": (
+            (stdlib(main.user_response_body), users),
+            (lambda u: via_model("user")(main.user_payload(u)), users),
+            (main.user_response_body, users),
+        ),
+        "/api/media-kit": (
+            (lambda kit: JSONResponse(jsonable_encoder(kit)).body, kits),
+            (via_model("media_kit"), kits),
+            (main.encode_json, kits),
+        ),
+        "/api/profile-tips": (
+            (lambda t: JSONResponse(jsonable_encoder(t)).body, tips),
+            (via_model("profile_tips"), tips),
+            (main.profile_tips_body, tips),
+        ),
+        "/api/dashboard": (
+            (lambda d: JSONResponse(jsonable_encoder(d)).body, dashboards),
+            None,
+            (lambda d: main.FastJSONResponse(jsonable_encoder(d)).body, dashboards),
+        ),
+    }
+    for route, (before, _, after) in cases.items():
+        # stesso output byte per byte prima/dopo
+        assert before[0](before[1][0]) == after[0](after[1][0]), route
+
+    results = {}
+    for route, (before, model, after) in cases.items():
+        before_us = time_per_op(before[0], before[1], n)
+        after_us = time_per_op(after[0], after[1], n)
+        results[route] = {
+            "before_us": round(before_us, 2),
+            "response_model_us": round(time_per_op(model[0], model[1], n), 2) if model else None,
+            "after_us": round(after_us, 2),
+            "speedup": round(before_us / after_us, 1) if after_us else 0.0,
+        }
+    return {
+        "config": {"iterations": n, "orjson": main.orjson is not None},
+        "serialization": results,
+    }
+
+def print_serialization_report(result: Dict[str, Any]) -> None:
+    cfg = result["config"]
+    print(f"\nserializzazione per richiesta (µs/op)  iterazioni={cfg['iterations']}  orjson={cfg['orjson']}")
+    print(f"{'rotta':<22}{'prima':>10}{'model':>10}{'ora':>10}{'x':>7}")
+    for route, r in result["serialization"].items():
+        model = f"{r['response_model_us']:.2f}" if r["response_model_us"] is not None else "-"
+        print(f"{route:<22}{r['before_us']:>10.2f}{model:>10}{r['after_us']:>10.2f}{r['speedup']:>7.1f}")
+
+
+# =======================
+# RICONCILIAZIONE STRIPE (stub locale)
+# =======================
+FAKE_PRICES = {
+    "emerging": ("price_bench_emerging_m", 490),
+    "pro": ("price_bench_pro_m", 990),
+    "agency": ("price_bench_agency_3", 29900),
+}
+
+def seed_stripe_drift(main: Any, n: int) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]], Dict[str, int]]:
+    """Utenti + abbonamenti Stripe con 1 utente su 4 fuori sync (webhook persi).
+
+    Ritorna (abbonamenti per lo stub, stato atteso per utente, correzioni attese).
+    """
+    now = int(time.time())
+    created_at = datetime.now(timezone.utc) - timedelta(days=400)
+    users: List[Dict[str, Any]] = []
+    subs: List[Dict[str, Any]] = []
+    expected: Dict[str, Dict[str, Any]] = {}
+    corrections = {"linked": 0, "updated": 0, "canceled": 0, "skipped_recent": 0}
+    plans = ("emerging", "pro", "agency")
+
+    def sub(i: int, customer: str, email: str, plan: str, status: str = "active", age_days: int = 0, price: Optional[str] = None) -> str:
+        sub_id = f"sub_bench_{i:07d}_{age_days}"
+        price_id, amount = FAKE_PRICES[plan]
+        subs.append({
+            "id": sub_id, "object": "subscription", "customer": customer, "email": email, "status": status,
+            "created": now - (i * 104_729) % (365 * 86400) - age_days * 86400,
+            "items": {"object": "list", "data": [{"id": f"si_{sub_id}", "object": "subscription_item", "quantity": 1,
+                                                   "price": {"id": price or price_id, "object": "price", "unit_amount": amount}}]},
+        })
+        return sub_id
+
+    for i in range(n):
+        uid, email, customer = f"recon-{i:07d}", f"recon-{i:07d}@bench.example.com", f"cus_bench_{i:07d}"
+        plan = plans[i % 3]
+        followers = 400_000 if plan == "agency" else 50_000
+        case = i % 16
+        row = {
+            "user_id": uid, "email": email, "password": "x", "main_platform": "instagram", "username": uid,
+            "followers": followers, "profiles_count": 3 if plan == "agency" else 1,
+            "segment": main.compute_segment(followers, 3 if plan == "agency" else 1),
+            "created_at": created_at, "updated_at": created_at,
+        }
+        if case == 12:
+            # checkout.session.completed perso: mai collegato, lo ritrova per email
+            row.update(paid_plan="free", is_premium=False, stripe_customer_id=None, stripe_subscription_id=None)
+            sid = sub(i, customer, email, plan)
+            expected[uid] = {"paid_plan": plan, "stripe_customer_id": customer, "stripe_subscription_id": sid}
+            corrections["linked"] += 1
+        elif case == 13:
+            # customer.subscription.deleted perso: su Stripe è cancellato
+            sid = sub(i, customer, email, plan, status="canceled")
+            row.update(paid_plan=plan, is_premium=True, stripe_customer_id=customer, stripe_subscription_id=sid)
+            expected[uid] = {"paid_plan": "free", "stripe_customer_id": customer, "stripe_subscription_id": None}
+            corrections["canceled"] += 1
+        elif case == 14:
+            # upgrade con webhook perso: due abbonamenti attivi, vale il più recente
+            old = sub(i, customer, email, "emerging", age_days=30)
+            new = sub(i, customer, email, "pro")
+            row.update(paid_plan="emerging", is_premium=True, stripe_customer_id=customer, stripe_subscription_id=old)
+            expected[uid] = {"paid_plan": "pro", "stripe_customer_id": customer, "stripe_subscription_id": new}
+            corrections["updated"] += 1
+        elif case == 15:
+            # fuori sync ma aggiornato dopo l'inizio del job: non va toccato
+            sid = sub(i, customer, email, plan, status="incomplete_expired")
+            row.update(paid_plan=plan, is_premium=True, stripe_customer_id=customer, stripe_subscription_id=sid,
+                       updated_at=datetime.now(timezone.utc) + timedelta(days=1))
+            expected[uid] = {"paid_plan": plan, "stripe_customer_id": customer, "stripe_subscription_id": sid}
+            corrections["skipped_recent"] += 1
+        else:
+            # in sync (un terzo con price sconosciuto: piano dall'importo)
+            sid = sub(i, customer, email, plan, price=f"price_legacy_{plan}" if case % 3 == 0 else None)
+            row.update(paid_plan=plan, is_premium=True, stripe_customer_id=customer, stripe_subscription_id=sid)
+            expected[uid] = {"paid_plan": plan, "stripe_customer_id": customer, "stripe_subscription_id": sid}
+        users.append(row)
+
+    t_users = main.UserRow.__table__
+    with main.engine.begin() as conn:
+        conn.execute(t_users.delete().where(t_users.c.user_id.like("recon-%")))
+        for i in range(0, len(users), 1000):
+            conn.execute(t_users.insert(), users[i:i + 1000])
+        main.rebuild_user_stats(conn)
+    return subs, expected, corrections
+
+def check_reconciled(main: Any, expected: Dict[str, Dict[str, Any]]) -> List[str]:
+    from sqlalchemy import select
+
+    t_users = main.UserRow.__table__
+    with main.engine.connect() as conn:
+        rows = conn.execute(select(
+            t_users.c.user_id, t_users.c.paid_plan, t_users.c.is_premium,
+            t_users.c.stripe_customer_id, t_users.c.stripe_subscription_id,
+        ).where(t_users.c.user_id.like("recon-%"))).all()
+        # i contatori scesi a zero restano come righe vuote, il ricalcolo non le crea
+        stats = sorted(tuple(r) for r in conn.execute(select(main.UserStatsRow.__table__)).all() if r.users or r.mrr_cents)
+    problems = []
+    for r in rows:
+        want = expected[r.user_id]
+        got = {"paid_plan": r.paid_plan, "stripe_customer_id": r.stripe_customer_id, "stripe_subscription_id": r.stripe_subscription_id}
+        if got != want or bool(r.is_premium) != (want["paid_plan"] != "free"):
+            problems.append(f"{r.user_id}: {got} != {want}")
+    with main.engine.begin() as conn:
+        main.rebuild_user_stats(conn)
+        rebuilt = sorted(tuple(r) for r in conn.execute(select(main.UserStatsRow.__table__)).all())
+    if stats != rebuilt:
+        problems.append("user_stats incrementale diversa dal ricalcolo")
+    return problems
+
+STRIPE_RECONCILE_CONFIGS = (
+    ("sequenziale (1 thread)", 1, 20.0),
+    ("4 thread, 20 rps", 4, 20.0),
+    ("8 thread, 100 rps (oltre il limite)", 8, 100.0),
+)
+
+def run_stripe_reconcile(args: argparse.Namespace) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="bench-stripe-") as workdir:
+        os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'reconcile.db')}"
+        os.environ["STRIPE_PRICE_EMERGING_MONTHLY"] = FAKE_PRICES["emerging"][0]
+        os.environ["STRIPE_PRICE_PRO_MONTHLY"] = FAKE_PRICES["pro"][0]
+        os.environ["STRIPE_PRICE_AGENCY_3"] = FAKE_PRICES["agency"][0]
+        os.environ["STRIPE_RECONCILE_INTERVAL_MINUTES"] = "0"
+        fake = None
+        main = None
+        try:
+            # lo stub è quello dei test (tests/stripe_stub.py): serve solo a questa modalità
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests"))
+            from stripe_stub import FakeStripe
+
+            # lo stub serve prima di importare main: STRIPE_API_BASE è letto all'import
+            fake = FakeStripe(args.stripe_latency_ms / 1000.0, args.stripe_rps)
+            os.environ["STRIPE_API_BASE"] = fake.start()
+            main = load_app(args)
+            main.ensure_schema()
+            subs, expected, want = seed_stripe_drift(main, args.stripe_reconcile)
+            fake.load(subs)
+
+            results = {}
+            for name, concurrency, rps in STRIPE_RECONCILE_CONFIGS:
+                before = dict(fake.stats)
+                r = main.reconcile_stripe(dry_run=True, concurrency=concurrency, rps=rps)
+                if r["corrections"] != want:
+                    raise RuntimeError(f"{name}: differenze {r['corrections']} != attese {want}")
+                results[name] = {
+                    "seconds": r["seconds"],
+                    "list_seconds": r["list_seconds"],
+                    "diff_seconds": r["diff_seconds"],
+                    "requests": fake.stats["requests"] - before["requests"],
+                    "rate_limited": fake.stats["rate_limited"] - before["rate_limited"],
+                    "subscriptions_per_second": round(r["subscriptions"] / r["list_seconds"], 1) if r["list_seconds"] else 0.0,
+                }
+
+            applied = main.reconcile_stripe(concurrency=4, rps=20.0)
+            again = main.reconcile_stripe(concurrency=4, rps=20.0)
+            problems = check_reconciled(main, expected)
+            if again["applied"] or any(v for k, v in again["corrections"].items() if k != "skipped_recent"):
+                problems.append(f"secondo giro non vuoto: {again['corrections']}")
+        finally:
+            if fake is not None and fake._server is not None:
+                fake.stop()
+            if main is not None:
+                main.engine.dispose()
+    return {
+        "config": {
+            "database_url": (args.database_url or "sqlite (file temporaneo)").split("@")[-1],
+            "users": args.stripe_reconcile,
+            "subscriptions": len(subs),
+            "stub_latency_ms": args.stripe_latency_ms,
+            "stub_rps": args.stripe_rps,
+        },
+        "stripe_reconcile": results,
+        "applied": {"corrections": applied["corrections"], "applied": applied["applied"], "seconds": applied["seconds"]},
+        "problems": problems,
+    }
+
+def print_stripe_reconcile_report(result: Dict[str, Any]) -> None:
+    cfg = result["config"]
+    print(f"\nriconciliazione Stripe  db={cfg['database_url']}  utenti={cfg['users']}  abbonamenti={cfg['subscriptions']}  "
+          f"stub={cfg['stub_latency_ms']:g}ms/{cfg['stub_rps']:g}rps")
+    print(f"{'configurazione':<38}{'s':>8}{'listing':>9}{'diff':>8}{'req':>6}{'429':>6}{'abb/s':>9}")
+    for name, s in result["stripe_reconcile"].items():
+        print(f"{name:<38}{s['seconds']:>8.2f}{s['list_seconds']:>9.2f}{s['diff_seconds']:>8.2f}"
+              f"{s['requests']:>6}{s['rate_limited']:>6}{s['subscriptions_per_second']:>9.1f}")
+    a = result["applied"]
+    print(f"correzioni applicate: {a['applied']} {a['corrections']} in {a['seconds']:.2f}s")
+
+
+def compare_to_baseline(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Ritorna le regressioni: p95 o throughput peggiori della baseline oltre la tolleranza."""
+    problems = []
+    for route, base in baseline.get("routes", {}).items():
+        cur = result["routes"].get(route)
+        if cur is None:
+            continue
+        if cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{route}: p95 {cur['p95_ms']}ms > baseline {base['p95_ms']}ms (+{tolerance:.0%})")
+        if cur["errors"] > base.get("errors", 0):
+            problems.append(f"{route}: {cur['errors']} errori 5xx (baseline {base.get('errors', 0)})")
+    base_rps = baseline.get("throughput_rps", 0.0)
+    if base_rps and result["throughput_rps"] < base_rps * (1 - tolerance):
+        problems.append(f"throughput {result['throughput_rps']} rps < baseline {base_rps} rps (-{tolerance:.0%})")
+    return problems
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"\n{result['config']['target']}  db={result['config']['database_url']}  "
+          f"concurrency={result['config']['concurrency']}  iterations={result['config']['iterations']}")
+    print(f"{'route':<28}{'count':>7}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for route, s in result["routes"].items():
+        print(f"{route:<28}{s['count']:>7}{s['errors']:>5}{s['rps']:>9.1f}{s['p50_ms']:>9.2f}{s['p95_ms']:>9.2f}{s['p99_ms']:>9.2f}")
+    print(f"totale: {result['total_requests']} richieste in {result['wall_seconds']}s = {result['throughput_rps']} rps")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--base-url", help="uvicorn già avviato (default: app in-process)")
+    p.add_argument("--database-url", help="DATABASE_URL per il run in-process")
+    p.add_argument("--webhook-secret", default=os.getenv("STRIPE_WEBHOOK_SECRET", ""),
+                   help="segreto webhook del server remoto (senza: flusso Stripe saltato)")
+    p.add_argument("--concurrency", type=int, default=20)
+    p.add_argument("--iterations", type=int, default=10)
+    p.add_argument("--json", dest="json_out", help="scrive il risultato completo in questo file")
+    p.add_argument("--save-baseline", help="salva il risultato come baseline JSON")
+    p.add_argument("--check-baseline", help="confronta con una baseline JSON")
+    p.add_argument("--tolerance", type=float, default=0.25, help="regressione ammessa (0.25 = 25%%)")
+    p.add_argument("--startup", action="store_true", help="misura l'avvio a freddo invece del carico")
+    p.add_argument("--startup-runs", type=int, default=5)
+    p.add_argument("--startup-path", default="/api/user?user_id=startup-probe", help="prima richiesta dopo l'avvio")
+    p.add_argument("--budget-import-ms", type=float, default=0.0, help="budget per l'import di main (0 = nessuno)")
+    p.add_argument("--budget-first-request-ms", type=float, default=0.0, help="budget per la prima richiesta")
+    p.add_argument("--budget-cold-start-ms", type=float, default=0.0, help="budget spawn processo -> prima risposta")
+    p.add_argument("--contact-writes", type=int, default=0, help="misura il throughput di N POST /api/contact")
+    p.add_argument("--serialization", action="store_true", help="microbenchmark della serializzazione JSON")
+    p.add_argument("--serialization-iterations", type=int, default=20000)
+    p.add_argument("--stripe-reconcile", type=int, default=0, help="riconciliazione Stripe di N utenti contro uno stub locale")
+    p.add_argument("--stripe-latency-ms", type=float, default=200.0, help="latenza per richiesta dello stub Stripe")
+    p.add_argument("--stripe-rps", type=float, default=25.0, help="limite di richieste al secondo dello stub (25 = test mode)")
+    p.add_argument("--logins", action="store_true", help="solo login concorrenti (--concurrency x --iterations) con sonda sull'event loop")
+    return p.parse_args(argv)
+
+
+def main_startup(args: argparse.Namespace) -> int:
+    result = run_startup(args)
+    print_startup_report(result)
+    if args.json_out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json_out)), exist_ok=True)
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    problems = check_startup_budgets(result, args)
+    if problems:
+        print("\n❌ Budget di avvio superati:")
+        for p in problems:
+            print("  -", p)
+        return 1
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.startup:
+        return main_startup(args)
+    if args.serialization:
+        result = run_serialization(args)
+        print_serialization_report(result)
+        if args.json_out:
+            os.makedirs(os.path.dirname(os.path.abspath(args.json_out)), exist_ok=True)
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+        return 0
+    if args.contact_writes:
+        result = run_contact_writes(args)
+        print_contact_writes_report(result)
+        if args.json_out:
+            os.makedirs(os.path.dirname(os.path.abspath(args.json_out)), exist_ok=True)
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+        # +1: la richiesta di warmup
+        lost = [n for n, s in result["contact_writes"].items() if s["stored"] != args.contact_writes + 1]
+        if lost:
+            print("\n❌ Contatti mancanti nel DB:", ", ".join(lost))
+            return 1
+        return 0
+    if args.stripe_reconcile:
+        result = run_stripe_reconcile(args)
+        print_stripe_reconcile_report(result)
+        if args.json_out:
+            os.makedirs(os.path.dirname(os.path.abspath(args.json_out)), exist_ok=True)
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+        if result["problems"]:
+            print("\n❌ Stato dopo la riconciliazione diverso dall'atteso:")
+            for p in result["problems"][:20]:
+                print("  -", p)
+            return 1
+        print("\n✅ users e user_stats allineati a Stripe.")
+        return 0
+    result = asyncio.run(run_logins(args) if args.logins else run(args))
+    print_report(result)
+
+    for path in (args.json_out, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+
+    if args.check_baseline:
+        with open(args.check_baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare_to_baseline(result, baseline, args.tolerance)
+        if problems:
+            print("\n❌ Regressioni rispetto alla baseline:")
+            for p in problems:
+                print("  -", p)
+            return 1
+        print("\n✅ Nessuna regressione rispetto alla baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,5 @@
 // app/(tabs)/index.tsx
-import React, { useState } from 'react';
+import React, { useRef, useState } from 'react';
 import {
   View,
   Text,
@@ -57,10 +57,20 @@ type ProfileTips = {
   tips: string[];
 };
 
+// risposta di /api/signup e /api/login con include_dashboard=true
+type Dashboard = {
+  user: UserData;
+  media_kit: MediaKit;
+  profile_tips: ProfileTips | null;
+  profile_tips_error: { status_code: number; detail: string } | null;
+};
+
 export default function DashboardScreen() {
   const [currentUser, setCurrentUser] = useState<UserData | null>(null);
   const [mediaKit, setMediaKit] = useState<MediaKit | null>(null);
   const [profileTips, setProfileTips] = useState<ProfileTips | null>(null);
+  // media kit arrivato insieme a signup/login: usato al primo tap
+  const prefetchedMediaKit = useRef<MediaKit | null>(null);
 
   // signup form
   const [suEmail, setSuEmail] = useState('');
@@ -78,6 +88,12 @@ export default function DashboardScreen() {
   const [loginStatus, setLoginStatus] = useState<string | null>(null);
   const [mediaKitStatus, setMediaKitStatus] = useState<string | null>(null);
 
+  function applyDashboard(dashboard: Dashboard) {
+    setCurrentUser(dashboard.user);
+    setProfileTips(dashboard.profile_tips);
+    prefetchedMediaKit.current = dashboard.media_kit;
+  }
+
   async function fetchUser(userId: string) {
     try {
       const res = await fetch(
@@ -116,7 +132,7 @@ export default function DashboardScreen() {
 
     try {
       setSignupStatus("Creo l'account e calcolo il segmento...");
-      const res = await fetch(`${API_BASE}/api/signup`, {
+      const res = await fetch(`${API_BASE}/api/signup?include_dashboard=true`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -135,7 +151,11 @@ export default function DashboardScreen() {
       }
       const data = await res.json();
       setSignupStatus('Account creato. Segmento calcolato.');
-      await fetchUser(data.user_id);
+      if (data.dashboard) {
+        applyDashboard(data.dashboard);
+      } else {
+        await fetchUser(data.user_id);
+      }
     } catch (err) {
       console.log(err);
       setSignupStatus('Errore di rete.');
@@ -154,7 +174,7 @@ export default function DashboardScreen() {
 
     try {
       setLoginStatus('Verifico i dati di accesso...');
-      const res = await fetch(`${API_BASE}/api/login`, {
+      const res = await fetch(`${API_BASE}/api/login?include_dashboard=true`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -168,7 +188,11 @@ export default function DashboardScreen() {
         return;
       }
       const data = await res.json();
-      await fetchUser(data.user_id);
+      if (data.dashboard) {
+        applyDashboard(data.dashboard);
+      } else {
+        await fetchUser(data.user_id);
+      }
       setLoginStatus('Accesso effettuato.');
     } catch (err) {
       console.log(err);
@@ -182,6 +206,13 @@ export default function DashboardScreen() {
       return;
     }
 
+    if (prefetchedMediaKit.current) {
+      setMediaKit(prefetchedMediaKit.current);
+      prefetchedMediaKit.current = null;
+      setMediaKitStatus('Media kit aggiornato.');
+      return;
+    }
+
     try {
       setMediaKitStatus('Genero il media kit con i prezzi suggeriti...');
       const res = await fetch(
@@ -0,0 +1,165 @@
+"""Fixture comuni: app in-process su SQLite temporaneo (primario + replica).
+
+main legge la configurazione all'import, quindi l'ambiente va impostato qui,
+prima di importarlo. La replica è configurata ma resta "non sana" (letture
+sul primario) salvo nei test che la attivano esplicitamente.
+"""
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.mkdtemp(prefix="forcreators-tests-")
+
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TMP, 'primary.db')}"
+os.environ["REPLICA_DATABASE_URL"] = f"sqlite:///{os.path.join(TMP, 'replica.db')}"
+os.environ["STRIPE_SECRET_KEY"] = "sk_test_suite"
+os.environ["STRIPE_WEBHOOK_SECRET"] = "whsec_suite"
+os.environ["STRIPE_RECONCILE_INTERVAL_MINUTES"] = "0"
+os.environ["STRIPE_PRICE_EMERGING_MONTHLY"] = "price_test_emerging_m"
+os.environ["STRIPE_PRICE_PRO_MONTHLY"] = "price_test_pro_m"
+os.environ["STRIPE_PRICE_AGENCY_3"] = "price_test_agency_3"
+os.environ["ADMIN_TOKEN"] = "admin-test"
+os.environ["WRITE_BUFFER_ENABLED"] = "0"
+os.environ["SCHEMA_CHECK"] = "off"
+# argon2-cffi è opzionale: i test usano scrypt, con un pool piccolo
+os.environ["PASSWORD_HASH_SCHEME"] = "scrypt"
+os.environ["PASSWORD_HASH_WORKERS"] = "2"
+
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+
+from resend_stub import FakeResend  # noqa: E402
+from stripe_stub import FakeStripe  # noqa: E402
+
+# niente rete verso Stripe e Resend: gli URL vanno impostati prima di importare main
+STRIPE_STUB = FakeStripe(latency=0.0, rps=1000.0)
+os.environ["STRIPE_API_BASE"] = STRIPE_STUB.start()
+RESEND_STUB = FakeResend()
+os.environ["RESEND_API_BASE"] = RESEND_STUB.start()
+os.environ["RESEND_API_KEY"] = "re_test_suite"
+os.environ["RESEND_BATCH_SIZE"] = "5"
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema() -> None:
+    main.ensure_schema()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def password_pool():
+    yield
+    main.close_password_pool()
+
+
+@pytest.fixture(autouse=True)
+def isolated_state():
+    # cache, read-your-writes e stato replica sono per processo: ogni test parte pulito
+    main.payload_cache.__init__(main.MEDIA_CACHE_MAX_ENTRIES, main.MEDIA_CACHE_TTL_SECONDS)
+    main._recent_writes.clear()
+    main.replica_state.update(healthy=False, lag_seconds=None, last_error=None)
+    yield
+    main.replica_state.update(healthy=False, lag_seconds=None, last_error=None)
+
+
+@pytest.fixture
+def stripe_stub():
+    STRIPE_STUB.load([])
+    STRIPE_STUB.stats.update(requests=0, rate_limited=0)
+    yield STRIPE_STUB
+    STRIPE_STUB.load([])
+
+
+@pytest.fixture
+def resend_stub():
+    # outbox vuota: i contatti degli altri test non finiscono negli invii
+    with main.engine.begin() as conn:
+        conn.execute(main.EmailOutboxRow.__table__.delete())
+    RESEND_STUB.reset()
+    yield RESEND_STUB
+    RESEND_STUB.reset()
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.fixture
+async def client():
+    # senza lifespan: i worker non partono, i test drenano le code da sé
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
+    # connessioni aiosqlite legate all'event loop del test
+    await main.async_engine.dispose()
+    await main.replica_engine.dispose()
+
+
+def create_user(**fields: Any) -> Dict[str, Any]:
+    """Inserisce un utente (user_stats inclusa) senza passare dall'hash della password."""
+    followers = int(fields.pop("followers", 5_000))
+    profiles_count = int(fields.pop("profiles_count", 1))
+    segment = main.compute_segment(followers, profiles_count)
+    uid = fields.pop("user_id", None) or str(uuid.uuid4())
+    row = {
+        "user_id": uid,
+        "email": f"{uid}@test.example.com",
+        "password": "x",
+        "main_platform": "instagram",
+        "username": f"user_{uid[:8]}",
+        "followers": followers,
+        "profiles_count": profiles_count,
+        "segment": segment,
+        "plan_key": main.compute_plan_key(segment, profiles_count),
+        "is_premium": False,
+        "paid_plan": "free",
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc),
+    }
+    row.update(fields)
+    row["is_premium"] = row["paid_plan"] != "free"
+    with main.db() as s:
+        s.execute(main.UserRow.__table__.insert(), row)
+        state = main.stats_state(row["segment"], row["paid_plan"], row["main_platform"], followers, row["plan_key"])
+        main.bump_user_stats(s, [(None, state)])
+    return row
+
+
+def stripe_signature(body: str, secret: str = "whsec_suite") -> str:
+    # stesso formato dell'header stripe-signature (t=...,v1=HMAC-SHA256)
+    ts = int(time.time())
+    sig = hmac.new(secret.encode(), f"{ts}.{body}".encode(), hashlib.sha256).hexdigest()
+    return f"t={ts},v1={sig}"
+
+
+async def post_stripe_event(client: Any, event: Dict[str, Any]) -> Any:
+    body = json.dumps({"object": "event", **event})
+    headers = {"stripe-signature": stripe_signature(body), "content-type": "application/json"}
+    return await client.post("/stripe/webhook", content=body, headers=headers)
+
+
+def stats_snapshot() -> list:
+    """user_stats senza i contatori scesi a zero (il ricalcolo non li crea)."""
+    with main.engine.connect() as conn:
+        rows = conn.execute(main.select(main.UserStatsRow.__table__)).all()
+    return sorted(tuple(r) for r in rows if r.users or r.mrr_cents)
+
+
+def rebuilt_stats() -> list:
+    """user_stats ricalcolata da zero su users."""
+    with main.engine.begin() as conn:
+        main.rebuild_user_stats(conn)
+    return stats_snapshot()
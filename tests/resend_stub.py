@@ -0,0 +1,95 @@
+"""Stub locale dell'API Resend (POST /emails e /emails/batch), per i test.
+
+Si avvia su una porta libera di 127.0.0.1; main va puntato lì con
+RESEND_API_BASE prima dell'import.
+"""
+import json
+import re
+import threading
+import uuid
+from typing import Any, Dict, List, Tuple
+
+# controllo minimo degli indirizzi, come fa Resend prima di accettare un invio
+_ADDRESS_RE = re.compile(r"(?:[^<>]*<)?[^@\s<>]+@[^@\s<>]+\.[^@\s<>]+>?")
+
+
+class FakeResend:
+    """Stub di Resend: registra le email accettate.
+
+    Un batch con anche un solo indirizzo non valido viene rifiutato per
+    intero con 422, come l'API vera. `fail_next(status, n)` fa rispondere
+    `status` alle prossime n richieste (429/5xx per gli errori temporanei).
+    """
+
+    def __init__(self) -> None:
+        self.sent: List[Dict[str, Any]] = []
+        self.requests: List[Tuple[str, int]] = []  # (path, email nella richiesta)
+        self._failures: List[int] = []
+        self._lock = threading.Lock()
+        self._server: Any = None
+
+    def reset(self) -> None:
+        with self._lock:
+            self.sent.clear()
+            self.requests.clear()
+            self._failures.clear()
+
+    def fail_next(self, status: int, n: int = 1) -> None:
+        with self._lock:
+            self._failures.extend([status] * n)
+
+    @staticmethod
+    def invalid_address(email: Dict[str, Any]) -> str:
+        addresses = [email.get("from", "")] + list(email.get("to", []))
+        if "reply_to" in email:
+            addresses.append(email["reply_to"])
+        return next((a for a in addresses if not _ADDRESS_RE.fullmatch(a or "")), "")
+
+    def handle(self, path: str, body: Any) -> Tuple[int, Any]:
+        batch = path == "/emails/batch"
+        emails = body if batch else [body]
+        with self._lock:
+            self.requests.append((path, len(emails)))
+            if self._failures:
+                status = self._failures.pop(0)
+                return status, {"statusCode": status, "name": "application_error", "message": "errore simulato"}
+            bad = next((a for a in map(self.invalid_address, emails) if a), None)
+            if bad is not None:
+                return 422, {"statusCode": 422, "name": "validation_error", "message": f"Invalid address: {bad}"}
+            ids = [{"id": str(uuid.uuid4())} for _ in emails]
+            self.sent.extend(emails)
+        return 200, ({"data": ids} if batch else ids[0])
+
+    def start(self) -> str:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self) -> None:
+                raw = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+                if self.path not in ("/emails", "/emails/batch"):
+                    status, body = 404, {"statusCode": 404, "name": "not_found", "message": "Not found"}
+                else:
+                    status, body = fake.handle(self.path, json.loads(raw))
+                out = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
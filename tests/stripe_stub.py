@@ -0,0 +1,106 @@
+"""Stub locale dell'API Stripe (GET /v1/subscriptions), per i test e per bench.py.
+
+Si avvia su una porta libera di 127.0.0.1; main va puntato lì con
+STRIPE_API_BASE prima dell'import.
+"""
+import bisect
+import json
+import threading
+import time
+from typing import Any, Dict, List
+
+
+class FakeStripe:
+    """Stub di GET /v1/subscriptions: paginazione, created[gte|lt], expand del customer.
+
+    Ogni risposta attende `latency` secondi (rete + Stripe) e oltre `rps`
+    richieste al secondo risponde 429 come l'API vera, senza Retry-After.
+    """
+
+    def __init__(self, latency: float, rps: float):
+        self.subs: List[Dict[str, Any]] = []
+        self.keys: List[int] = []
+        self.index: Dict[str, int] = {}
+        self.latency = latency
+        self.rps = rps
+        self.stats = {"requests": 0, "rate_limited": 0}
+        self._tokens = rps
+        self._refill_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._server: Any = None
+
+    def load(self, subscriptions: List[Dict[str, Any]]) -> None:
+        # ordine di Stripe: più recenti prima; i cancellati non compaiono nel listing di default
+        self.subs = sorted((s for s in subscriptions if s["status"] != "canceled"), key=lambda s: (-s["created"], s["id"]))
+        self.keys = [-s["created"] for s in self.subs]
+        self.index = {s["id"]: i for i, s in enumerate(self.subs)}
+
+    def allow(self) -> bool:
+        with self._lock:
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            self._tokens = min(self.rps, self._tokens + (now - self._refill_at) * self.rps)
+            self._refill_at = now
+            if self._tokens < 1:
+                self.stats["rate_limited"] += 1
+                return False
+            self._tokens -= 1
+            return True
+
+    def list_page(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+        limit = min(100, int(query.get("limit", ["10"])[0]))
+        start, end = 0, len(self.subs)
+        if "created[lt]" in query:
+            start = bisect.bisect_right(self.keys, -int(query["created[lt]"][0]))
+        if "created[gte]" in query:
+            end = bisect.bisect_right(self.keys, -int(query["created[gte]"][0]))
+        if "starting_after" in query:
+            start = max(start, self.index[query["starting_after"][0]] + 1)
+        expand = "data.customer" in [v for k, vs in query.items() if k.startswith("expand") for v in vs]
+        data = []
+        for s in self.subs[start:min(end, start + limit)]:
+            s = dict(s)
+            s["customer"] = {"id": s["customer"], "object": "customer", "email": s.pop("email")} if expand else s["customer"]
+            s.pop("email", None)
+            data.append(s)
+        return {"object": "list", "url": "/v1/subscriptions", "has_more": start + limit < end, "data": data}
+
+    def start(self) -> str:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, urlsplit
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # header e body in due write: senza questo Nagle + delayed ACK aggiungono ~40ms
+            disable_nagle_algorithm = True
+
+            def do_GET(self) -> None:
+                time.sleep(fake.latency)
+                url = urlsplit(self.path)
+                if url.path != "/v1/subscriptions":
+                    status, body = 404, {"error": {"type": "invalid_request_error", "message": "Unrecognized request URL"}}
+                elif not fake.allow():
+                    status, body = 429, {"error": {"type": "invalid_request_error", "code": "rate_limit",
+                                                   "message": "Too many requests hit the API too quickly."}}
+                else:
+                    status, body = 200, fake.list_page(parse_qs(url.query))
+                raw = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
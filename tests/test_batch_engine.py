@@ -0,0 +1,111 @@
+"""Il motore batch (NumPy) deve dare esattamente i risultati del calcolo scalare."""
+import random
+
+import numpy as np
+import pytest
+
+import main
+
+SEGMENT_EDGES = [0, 2_000, 10_000, 200_000]
+PLATFORMS = ["instagram", "tiktok", "youtube", "twitch", "TikTok", "YOUTUBE", "snapchat", "", None]
+
+
+def boundary_followers() -> list:
+    values = {-5, -1}
+    for edge in SEGMENT_EDGES:
+        values.update(edge + d for d in range(-3, 4))
+    # prezzo minimo (5€ post, 3€ story) e dintorni per ogni tariffa al migliaio
+    for rate in set(main.BASE_RATE_PER_1K.values()):
+        for price in (3.0, 5.0, 6.0, 10.0):
+            f = int(price * 1000 / rate)
+            values.update(f + d for d in range(-2, 3))
+    return sorted(values)
+
+
+def tie_followers(n: int, rng: random.Random) -> list:
+    """Follower che portano post, story o bundle su un .xx5 (quasi-pareggio)."""
+    found = []
+    while len(found) < n:
+        f = rng.randrange(500, 3_000_000)
+        for rate in set(main.BASE_RATE_PER_1K.values()):
+            post = max((f / 1000.0) * rate, 5.0)
+            story = max(round(post, 2) * 0.5, 3.0)
+            bundle = (round(post, 2) + 3 * round(story, 2)) * 0.8
+            if any(abs(x * 100 - int(x * 100) - 0.5) < 1e-6 for x in (post, story, bundle)):
+                found.append(f)
+                break
+    return found
+
+
+def scalar_media_kit(p: dict) -> dict:
+    segment = main.compute_segment(p["followers"], p["profiles_count"])
+    user = main.UserRow(
+        username=p["username"],
+        main_platform=p["main_platform"],
+        followers=p["followers"],
+        profiles_count=p["profiles_count"],
+        segment=segment,
+    )
+    kit = main.compute_media_kit(user)
+    return {
+        "username": kit["username"],
+        "main_platform": kit["main_platform"],
+        "segment": segment,
+        "segment_label": kit["segment_label"],
+        "required_plan": main.SEGMENT_TO_PLAN[segment],
+        "plan": main.compute_plan(segment, p["profiles_count"]),
+        "followers": kit["followers"],
+        "estimated": kit["estimated"],
+        "suggested_rates_eur": kit["suggested_rates_eur"],
+    }
+
+
+def random_profiles(seed: int, n: int) -> list:
+    rng = random.Random(seed)
+    followers = boundary_followers() + tie_followers(300, rng)
+    followers += [int(10 ** rng.uniform(0, 7.5)) for _ in range(n)]
+    profiles = []
+    for i, f in enumerate(followers):
+        profiles.append({
+            "username": f"u{i}",
+            "main_platform": rng.choice(PLATFORMS),
+            "followers": f,
+            "profiles_count": rng.choice([0, 1, 1, 1, 2, 3, 4, 5, 6, 12]),
+        })
+    rng.shuffle(profiles)
+    return profiles
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_batch_media_kits_match_scalar(seed):
+    profiles = random_profiles(seed, 3_000)
+    batch = main.batch_media_kits(profiles)
+    assert len(batch) == len(profiles)
+    for p, got in zip(profiles, batch):
+        expected = scalar_media_kit(p)
+        # confronto sul JSON: distingue anche 5 da 5.0
+        assert main.encode_json(got) == main.encode_json(expected), p
+
+
+def test_compute_batch_segments_and_plans_match_scalar():
+    profiles = random_profiles(4, 2_000)
+    out = main.compute_batch(
+        [p["followers"] for p in profiles],
+        [p["profiles_count"] for p in profiles],
+        [p["main_platform"] for p in profiles],
+    )
+    for i, p in enumerate(profiles):
+        segment = main.compute_segment(p["followers"], p["profiles_count"])
+        assert main.SEGMENT_CODES[out["segment"][i]] == segment
+        key = main._BATCH_PLAN_KEYS[(int(out["segment"][i]), int(out["agency_tier"][i]))]
+        assert key == main.compute_plan_key(segment, p["profiles_count"])
+        assert main.PLAN_CATALOG[key] == main.compute_plan(segment, p["profiles_count"])
+
+
+def test_round2_matches_round_on_ties():
+    rng = random.Random(5)
+    # valori con esattamente tre decimali che finiscono per 5, più rumore attorno
+    values = [rng.randrange(0, 10_000_000) / 1000.0 for _ in range(20_000)]
+    values += [(rng.randrange(0, 1_000_000) * 10 + 5) / 1000.0 for _ in range(20_000)]
+    got = main._round2(np.array(values))
+    assert got.tolist() == [round(v, 2) for v in values]
@@ -0,0 +1,98 @@
+"""Hash/verifica password sul pool di processi (scrypt, 2 worker: vedi conftest)."""
+import asyncio
+import os
+import uuid
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select
+
+import main
+from conftest import create_user
+
+
+def stored_password(user_id: str) -> str:
+    with main.engine.connect() as conn:
+        return conn.execute(select(main.UserRow.password).where(main.UserRow.user_id == user_id)).scalar_one()
+
+
+async def login(client, email: str, password: str):
+    return await client.post("/api/login", json={"email": email, "password": password})
+
+
+@pytest.mark.anyio
+async def test_signup_hashes_and_login_verifies(client):
+    email = f"cred-{uuid.uuid4().hex[:8]}@example.com"
+    r = await client.post("/api/signup", json={
+        "email": email, "password": "giusta", "main_platform": "instagram",
+        "username": "cred", "followers": 1_000,
+    })
+    assert r.status_code == 200
+    user_id = r.json()["user_id"]
+    stored = stored_password(user_id)
+    assert stored.startswith("$scrypt$ln=14,r=8,p=1$") and main.is_password_hash(stored)
+
+    assert (await login(client, email, "giusta")).json()["user_id"] == user_id
+    assert (await login(client, email, "sbagliata")).status_code == 400
+    assert (await login(client, "nessuno@example.com", "giusta")).status_code == 400
+    assert stored_password(user_id) == stored  # hash attuale: nessun aggiornamento
+
+
+@pytest.mark.anyio
+async def test_legacy_plaintext_is_rehashed_on_login(client):
+    user = create_user(password="in-chiaro")
+    assert (await login(client, user["email"], "sbagliata")).status_code == 400
+    assert stored_password(user["user_id"]) == "in-chiaro"
+
+    assert (await login(client, user["email"], "in-chiaro")).status_code == 200
+    upgraded = stored_password(user["user_id"])
+    assert upgraded != "in-chiaro" and main.is_password_hash(upgraded)
+    assert main._verify_password(upgraded, "in-chiaro", "scrypt") == (True, None)
+
+    assert (await login(client, user["email"], "in-chiaro")).status_code == 200
+    assert stored_password(user["user_id"]) == upgraded
+
+
+@pytest.mark.anyio
+async def test_hash_with_old_parameters_is_upgraded(client, monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(main, "SCRYPT_N", 2 ** 10)
+        weak = main._hash_password("pw", "scrypt")
+    user = create_user(password=weak)
+    assert (await login(client, user["email"], "pw")).status_code == 200
+    assert stored_password(user["user_id"]).startswith("$scrypt$ln=14,")
+
+
+@pytest.mark.anyio
+async def test_full_queue_answers_503_immediately(client, monkeypatch):
+    user = create_user(password=main._hash_password("pw", "scrypt"))
+    await main.warm_password_pool()
+    monkeypatch.setattr(main, "PASSWORD_HASH_MAX_PENDING", 1)
+    rejected_before = main.PASSWORD_HASH_REJECTED._values.get(("verify",), 0.0)
+
+    responses = await asyncio.gather(*(login(client, user["email"], "pw") for _ in range(6)))
+    codes = sorted(r.status_code for r in responses)
+    assert 200 in codes and 503 in codes
+    assert set(codes) == {200, 503}
+    busy = next(r for r in responses if r.status_code == 503)
+    assert busy.headers["retry-after"] == "1"
+    assert main.PASSWORD_HASH_REJECTED._values[("verify",)] - rejected_before == codes.count(503)
+    assert main._password_pending == 0
+
+
+@pytest.mark.anyio
+async def test_pool_is_recreated_after_a_worker_dies(client):
+    user = create_user(password=main._hash_password("pw", "scrypt"))
+    assert (await login(client, user["email"], "pw")).status_code == 200
+    broken = main._password_pool
+
+    # un worker che muore (OOM, kill) rompe tutto il pool
+    with pytest.raises(HTTPException) as exc:
+        await main.run_credential_op("verify", os._exit, 1)
+    assert exc.value.status_code == 503
+    assert main._password_pool is None
+
+    r = await login(client, user["email"], "pw")
+    assert r.status_code == 200
+    assert main._password_pool is not None and main._password_pool is not broken
+    assert main._password_pending == 0
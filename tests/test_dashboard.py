@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import update
+
+import main
+from conftest import create_user
+
+
+def change_row_elsewhere(user_id: str, **fields) -> None:
+    # scrittura fatta da un altro worker: la cache di questo processo non lo sa
+    fields.setdefault("updated_at", datetime.now(timezone.utc) + timedelta(seconds=5))
+    with main.engine.begin() as conn:
+        conn.execute(update(main.UserRow).where(main.UserRow.user_id == user_id).values(**fields))
+
+
+def assert_parts_agree(body: dict) -> None:
+    user, kit = body["user"], body["media_kit"]
+    assert kit["followers"] == user["followers"]
+    assert kit["segment"] == user["segment"]
+    required = main.SEGMENT_TO_PLAN[user["segment"]]
+    assert kit["locked"] == (main.PLAN_ORDER[user["paid_plan"]] < main.PLAN_ORDER[required])
+    tips_unlocked = user["segment"] == "casual" or user["is_premium"]
+    assert (body["profile_tips"] is not None) == tips_unlocked
+
+
+@pytest.mark.anyio
+async def test_dashboard_ignores_cached_payloads_of_another_version(client):
+    user = create_user(followers=5_000)
+    first = (await client.get("/api/dashboard", params={"user_id": user["user_id"]})).json()
+    assert_parts_agree(first)
+    assert first["media_kit"]["locked"] is True
+
+    change_row_elsewhere(
+        user["user_id"], followers=50_000, segment="pro", plan_key="pro",
+        paid_plan="pro", is_premium=True,
+    )
+    second = (await client.get("/api/dashboard", params={"user_id": user["user_id"]})).json()
+    assert second["user"]["followers"] == 50_000
+    assert_parts_agree(second)
+    assert second["media_kit"]["locked"] is False
+    assert second["profile_tips"] is not None
+
+
+@pytest.mark.anyio
+async def test_dashboard_with_older_row_than_cache(client):
+    # riga letta in ritardo (replica) mentre la cache ha già la versione nuova
+    user = create_user(followers=5_000)
+    newer = main.row_version(user["updated_at"]) + 60
+    main.payload_cache.put("media_kit", user["user_id"], newer, {"followers": 999_999})
+    main.payload_cache.put("profile_tips", user["user_id"], newer, (200, {"tips": []}))
+
+    body = (await client.get("/api/dashboard", params={"user_id": user["user_id"]})).json()
+    assert body["media_kit"]["followers"] == 5_000
+    assert_parts_agree(body)
@@ -0,0 +1,141 @@
+"""Outbox delle email contatti -> Resend (stub locale, tests/resend_stub.py)."""
+import json
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select, update
+
+import main
+
+
+def queue_contacts(n: int, reply_to=None) -> list:
+    """Mette in outbox n email (come farebbe /api/contact); reply_to: {indice: indirizzo}."""
+    reply_to = reply_to or {}
+    now = datetime.now(timezone.utc)
+    rows = []
+    for i in range(n):
+        record = {"name": f"Nome {i}", "email": reply_to.get(i, f"contatto{i}@example.com"),
+                  "subject": f"Oggetto {i}", "message": "Ciao!"}
+        rows.append({
+            "outbox_id": str(uuid.uuid4()), "contact_id": str(uuid.uuid4()),
+            "payload": json.dumps(main.build_contact_email(record)),
+            "created_at": now + timedelta(microseconds=i), "next_attempt_at": now,
+        })
+    with main.engine.begin() as conn:
+        conn.execute(main.EmailOutboxRow.__table__.insert(), rows)
+    return [r["outbox_id"] for r in rows]
+
+
+def outbox(ids) -> dict:
+    t = main.EmailOutboxRow.__table__
+    with main.engine.connect() as conn:
+        return {r.outbox_id: r for r in conn.execute(select(t).where(t.c.outbox_id.in_(list(ids)))).all()}
+
+
+def make_due(ids) -> None:
+    with main.engine.begin() as conn:
+        conn.execute(
+            update(main.EmailOutboxRow)
+            .where(main.EmailOutboxRow.outbox_id.in_(list(ids)))
+            .values(next_attempt_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+        )
+
+
+@pytest.fixture(autouse=True)
+async def resend_client():
+    yield
+    # client httpx legato all'event loop del test
+    await main.close_resend_client()
+
+
+@pytest.mark.anyio
+async def test_contact_is_sent_through_the_outbox(client, resend_stub):
+    r = await client.post("/api/contact", json={
+        "name": "Ada", "email": "ada@example.com", "subject": "Collaborazione", "message": "Ciao!",
+    })
+    assert r.status_code == 200
+    assert resend_stub.sent == []  # la risposta non aspetta Resend
+
+    assert await main.drain_email_outbox() == 1
+    [email] = resend_stub.sent
+    assert email["reply_to"] == "ada@example.com"
+    assert email["to"] == [main.CONTACT_RECIPIENT]
+    assert "Collaborazione" in email["subject"]
+    t = main.EmailOutboxRow.__table__
+    with main.engine.connect() as conn:
+        row = conn.execute(select(t).where(t.c.contact_id == r.json()["contact_id"])).one()
+    assert row.status == "sent" and row.sent_at is not None
+
+
+@pytest.mark.anyio
+async def test_malformed_contact_address_is_rejected_before_queueing(client, resend_stub):
+    for bad in ("non-una-email", "a@b", "due@indirizzi.it, altro@x.it", "<a@b.it>"):
+        r = await client.post("/api/contact", json={"name": "X", "email": bad, "subject": "S", "message": "M"})
+        assert r.status_code == 422, bad
+    with main.engine.connect() as conn:
+        assert conn.execute(select(main.EmailOutboxRow.outbox_id)).all() == []
+
+
+@pytest.mark.anyio
+async def test_pending_emails_go_out_in_batches(resend_stub):
+    ids = queue_contacts(12)
+    assert await main.drain_email_outbox() == 12
+    assert Counter(resend_stub.requests) == Counter({("/emails/batch", 5): 2, ("/emails/batch", 2): 1})
+    assert len(resend_stub.sent) == 12
+    assert {r.status for r in outbox(ids).values()} == {"sent"}
+    assert await main.drain_email_outbox() == 0
+
+
+@pytest.mark.anyio
+async def test_temporary_errors_back_off_then_succeed(resend_stub):
+    ids = queue_contacts(3)
+    resend_stub.fail_next(503)
+    before = datetime.now(timezone.utc)
+    assert await main.drain_email_outbox() == 3
+
+    rows = outbox(ids)
+    for r in rows.values():
+        assert r.status == "pending" and r.attempts == 1 and "503" in r.last_error
+        wait = (main.as_utc(r.next_attempt_at) - before).total_seconds()
+        assert main.outbox_backoff(1) - 1 <= wait <= main.outbox_backoff(1) + 1
+    # in attesa del backoff: il giro successivo non le riprende
+    assert await main.drain_email_outbox() == 0
+
+    make_due(ids)
+    resend_stub.fail_next(429)
+    await main.drain_email_outbox()
+    rows = outbox(ids)
+    assert {(r.status, r.attempts) for r in rows.values()} == {("pending", 2)}
+    assert main.outbox_backoff(2) == 2 * main.outbox_backoff(1)
+
+    make_due(ids)
+    await main.drain_email_outbox()
+    assert {r.status for r in outbox(ids).values()} == {"sent"}
+    assert len(resend_stub.sent) == 3
+
+
+@pytest.mark.anyio
+async def test_gives_up_after_max_attempts(resend_stub):
+    [oid] = queue_contacts(1)
+    resend_stub.fail_next(500, main.RESEND_MAX_ATTEMPTS + 1)
+    for _ in range(main.RESEND_MAX_ATTEMPTS + 1):
+        make_due([oid])
+        await main.drain_email_outbox()
+    row = outbox([oid])[oid]
+    assert row.status == "failed" and row.attempts == main.RESEND_MAX_ATTEMPTS
+
+
+@pytest.mark.anyio
+async def test_one_bad_address_does_not_fail_the_whole_batch(resend_stub):
+    # riga accodata prima della validazione in /api/contact
+    ids = queue_contacts(5, reply_to={2: "indirizzo rotto"})
+    assert await main.drain_email_outbox() == 5
+
+    rows = outbox(ids)
+    bad = rows[ids[2]]
+    assert bad.status == "failed" and "422" in bad.last_error
+    assert {rows[i].status for i in ids if i != ids[2]} == {"sent"}
+    assert len(resend_stub.sent) == 4
+    assert resend_stub.requests == [("/emails/batch", 5)] + [("/emails", 1)] * 5
@@ -0,0 +1,47 @@
+import pytest
+
+import main
+from conftest import create_user
+from test_dashboard import change_row_elsewhere
+
+PATHS = ["/api/user", "/api/media-kit", "/api/profile-tips"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", PATHS)
+async def test_if_none_match_is_checked_against_the_db(client, path):
+    user = create_user(followers=50_000, paid_plan="pro")
+    params = {"user_id": user["user_id"]}
+    first = await client.get(path, params=params)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    r = await client.get(path, params=params, headers={"if-none-match": etag})
+    assert r.status_code == 304
+    assert r.headers["etag"] == etag
+
+    # un altro worker cambia la riga: l'ETag in cache qui non deve bastare
+    change_row_elsewhere(user["user_id"], followers=60_000)
+    r = await client.get(path, params=params, headers={"if-none-match": etag})
+    assert r.status_code == 200
+    assert r.headers["etag"] != etag
+    if path != "/api/profile-tips":
+        assert r.json()["followers"] == 60_000
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/api/media-kit", "/api/profile-tips"])
+async def test_if_none_match_version_read_is_reused_for_the_cache(client, path):
+    user = create_user(followers=50_000, paid_plan="pro")
+    params = {"user_id": user["user_id"]}
+    await client.get(path, params=params)
+
+    with main.query_budget(select=1, total=1, exact=True):
+        r = await client.get(path, params=params, headers={"if-none-match": 'W/"altro"'})
+    assert r.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_if_none_match_for_unknown_user(client):
+    r = await client.get("/api/media-kit", params={"user_id": "nessuno"}, headers={"if-none-match": "*"})
+    assert r.status_code == 404
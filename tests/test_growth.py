@@ -0,0 +1,179 @@
+"""Storico follower: snapshot, rollup giorno/settimana, /api/growth e proiezione."""
+import random
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select
+
+import main
+from conftest import create_user
+
+DAY = 86400
+
+
+def record(points) -> None:
+    with main.engine.begin() as conn:
+        main.record_follower_history(conn, points)
+
+
+def snapshots(user_id: str) -> list:
+    t = main.FollowerSnapshotRow.__table__
+    with main.engine.connect() as conn:
+        return conn.execute(
+            select(t.c.user_id, t.c.ts, t.c.followers, t.c.profiles_count).where(t.c.user_id == user_id).order_by(t.c.ts)
+        ).all()
+
+
+def rollups(user_id: str) -> list:
+    t = main.FollowerRollupRow.__table__
+    cols = ["user_id", "granularity", "bucket_day", "first_ts", "first_followers", "last_ts", "last_followers",
+            "min_followers", "max_followers", "samples"]
+    with main.engine.connect() as conn:
+        rows = conn.execute(select(*[t.c[c] for c in cols]).where(t.c.user_id == user_id)).all()
+    return sorted((dict(r._mapping) for r in rows), key=lambda r: (r["granularity"], r["bucket_day"]))
+
+
+def expected_rollups(user_id: str) -> list:
+    # rollup ricalcolati da zero sugli snapshot salvati
+    rows = main.follower_rollup_rows(tuple(r) for r in snapshots(user_id))
+    return sorted(rows, key=lambda r: (r["granularity"], r["bucket_day"]))
+
+
+def test_same_second_update_replaces_the_sample():
+    uid = str(uuid.uuid4())
+    t0 = 20_000 * DAY + 3_600
+    record([(uid, t0, 1_000, 1), (uid, t0 + 60, 5_000, 1)])
+    # stesso secondo del secondo punto: lo sostituisce (anche il max 5_000 sparisce)
+    record([(uid, t0 + 60, 1_200, 1)])
+
+    assert [(r.ts, r.followers) for r in snapshots(uid)] == [(t0, 1_000), (t0 + 60, 1_200)]
+    day, week = rollups(uid)
+    for r in (day, week):
+        assert r["samples"] == 2
+        assert (r["min_followers"], r["max_followers"]) == (1_000, 1_200)
+        assert (r["first_followers"], r["last_followers"]) == (1_000, 1_200)
+    assert rollups(uid) == expected_rollups(uid)
+
+
+def test_duplicate_seconds_in_one_batch_count_once():
+    uid = str(uuid.uuid4())
+    t0 = 20_001 * DAY
+    record([(uid, t0, 100, 1), (uid, t0, 9_999, 1), (uid, t0, 300, 1)])
+    assert [(r.ts, r.followers) for r in snapshots(uid)] == [(t0, 300)]
+    assert {(r["samples"], r["min_followers"], r["max_followers"]) for r in rollups(uid)} == {(1, 300, 300)}
+
+
+@pytest.mark.anyio
+async def test_async_path_handles_rewrites_too():
+    uid = str(uuid.uuid4())
+    t0 = 20_002 * DAY
+    async with main.adb() as s:
+        await main.arecord_follower_history(s, [(uid, t0, 10, 1), (uid, t0 + 1, 50, 1)])
+    async with main.adb() as s:
+        await main.arecord_follower_history(s, [(uid, t0 + 1, 20, 1), (uid, t0 + 2, 30, 1)])
+    await main.async_engine.dispose()
+    assert rollups(uid) == expected_rollups(uid)
+    assert {r["samples"] for r in rollups(uid)} == {3}
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_rollups_match_recomputation_from_snapshots(seed):
+    rng = random.Random(seed)
+    uid = str(uuid.uuid4())
+    start = 20_100 * DAY
+    # pochi secondi possibili su tre settimane: tante collisioni, anche tra batch
+    seconds = [start + rng.randrange(21) * DAY + rng.randrange(4) for _ in range(30)]
+    for _ in range(25):
+        batch = [(uid, rng.choice(seconds), rng.randrange(0, 50_000), 1) for _ in range(rng.randrange(1, 5))]
+        record(batch)
+    assert rollups(uid) == expected_rollups(uid)
+
+
+def seed_linear_history(user_id: str, days: int, start_followers: int, per_day: int) -> int:
+    """Un punto al giorno (due il primo giorno), crescita lineare; ritorna i follower di oggi."""
+    today = int(time.time()) // DAY
+    points = []
+    for i in range(days, -1, -1):
+        ts = (today - i) * DAY + 600
+        points.append((user_id, ts, start_followers + (days - i) * per_day, 1))
+    points.append((user_id, (today - days) * DAY + 700, start_followers + 5, 1))
+    record(points)
+    return points[-2][2]
+
+
+@pytest.fixture
+def growing_user():
+    user = create_user(followers=1_000)
+    current = seed_linear_history(user["user_id"], days=60, start_followers=1_000, per_day=100)
+    with main.engine.begin() as conn:
+        conn.execute(
+            main.UserRow.__table__.update().where(main.UserRow.user_id == user["user_id"])
+            .values(followers=current, segment=main.compute_segment(current, 1))
+        )
+    return user["user_id"], current
+
+
+@pytest.mark.anyio
+async def test_growth_series_and_projection(client, growing_user):
+    uid, current = growing_user
+    assert current == 7_000
+
+    r = await client.get("/api/growth", params={"user_id": uid, "days": 30})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["granularity"] == "day"
+    assert body["current"] == {"followers": 7_000, "profiles_count": 1, "segment": "emerging"}
+    series = body["series"]
+    assert set(series) == {"t", "followers", "min", "max"}
+    assert series["followers"][-1] == 7_000
+    assert series["followers"] == sorted(series["followers"])
+    assert all(t % DAY == 0 for t in series["t"])
+
+    proj = body["projection"]
+    assert (proj["next_segment"], proj["threshold"]) == ("pro", 10_000)
+    assert proj["followers_per_day"] == pytest.approx(100, abs=1)
+    expected = (datetime.now(timezone.utc) + timedelta(days=30)).date()
+    assert abs((date.fromisoformat(proj["projected_date"]) - expected).days) <= 1
+    assert proj["based_on_days"] == 61
+
+    r = await client.get("/api/growth", params={"user_id": uid, "days": 7, "granularity": "raw"})
+    raw = r.json()["series"]
+    assert set(raw) == {"t", "followers"} and len(raw["t"]) == 7
+
+    r = await client.get("/api/growth", params={"user_id": uid, "days": 2 * 365})
+    weekly = r.json()
+    assert weekly["granularity"] == "week"
+    assert all(main.week_bucket(t // DAY) == t // DAY for t in weekly["series"]["t"])
+    assert weekly["series"]["min"][0] == 1_000
+
+
+@pytest.mark.anyio
+async def test_growth_rejects_bad_ranges(client, growing_user):
+    uid, _ = growing_user
+    for params in ({"days": 0}, {"days": main.GROWTH_MAX_DAYS + 1},
+                   {"days": main.GROWTH_RAW_MAX_DAYS + 1, "granularity": "raw"}):
+        r = await client.get("/api/growth", params={"user_id": uid, **params})
+        assert r.status_code == 400, params
+    r = await client.get("/api/growth", params={"user_id": "non-esiste"})
+    assert r.status_code == 404
+
+
+def test_project_next_segment_edge_cases():
+    now = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    top = main.project_next_segment([1, 2, 3], [1, 2, 3], 250_000, 1, now)
+    assert top["next_segment"] is None and top["projected_date"] is None
+    assert main.project_next_segment([1, 2], [5, 5], 500, 3, now)["next_segment"] is None  # agency per profili
+
+    single = main.project_next_segment([1], [500], 500, 1, now)
+    assert (single["next_segment"], single["threshold"], single["followers_per_day"]) == ("emerging", 2_000, None)
+
+    shrinking = main.project_next_segment([1, 2, 3], [1_500, 1_400, 1_300], 1_300, 1, now)
+    assert shrinking["followers_per_day"] == -100 and shrinking["projected_date"] is None
+
+    slow = main.project_next_segment([1, 2], [10_000, 10_001], 10_001, 1, now)
+    assert slow["next_segment"] == "agency" and slow["projected_date"] is None  # oltre GROWTH_PROJECTION_MAX_DAYS
+
+    fast = main.project_next_segment([1, 2], [1_000, 1_500], 1_500, 1, now)
+    assert fast["projected_date"] == "2026-01-02"
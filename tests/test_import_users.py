@@ -0,0 +1,128 @@
+"""Import bulk degli utenti: report per riga, duplicati e password."""
+import json
+import uuid
+
+import pytest
+from sqlalchemy import select
+
+import main
+from conftest import create_user, rebuilt_stats, stats_snapshot
+
+ADMIN = {"x-admin-token": "admin-test"}
+
+
+def record(email: str, password: str = "segreta", **fields) -> dict:
+    return {
+        "email": email, "password": password, "main_platform": "instagram",
+        "username": email.split("@")[0], "followers": 12_000, "profiles_count": 1, **fields,
+    }
+
+
+def unique_email(tag: str) -> str:
+    return f"{tag}-{uuid.uuid4().hex[:8]}@import.example.com"
+
+
+def stored_passwords(emails) -> dict:
+    with main.engine.connect() as conn:
+        rows = conn.execute(select(main.UserRow.email, main.UserRow.password).where(main.UserRow.email.in_(list(emails))))
+        return dict(rows.all())
+
+
+async def import_lines(client, lines, fmt="jsonl", chunk_size=1000) -> list:
+    r = await client.post(
+        "/api/admin/import-users", params={"format": fmt, "chunk_size": chunk_size},
+        content="\n".join(lines) + "\n", headers=ADMIN,
+    )
+    assert r.status_code == 200
+    return [json.loads(line) for line in r.text.splitlines()]
+
+
+@pytest.mark.anyio
+async def test_report_lists_invalid_and_duplicate_rows(client):
+    existing = create_user()
+    rebuilt_stats()  # altri test possono lasciare user_stats non allineata: si riparte da qui
+    a, b, c = unique_email("a"), unique_email("b"), unique_email("c")
+    lines = [
+        json.dumps(record(a)),
+        "{non è json",
+        json.dumps(record(b, followers="tanti")),
+        json.dumps(record(a, username="di_nuovo")),   # ripetuta nel file, stesso chunk
+        json.dumps(record(existing["email"])),      # già nel DB
+        "",
+        json.dumps(record(c)),
+        json.dumps(record(c)),                      # ripetuta, chunk successivo
+    ]
+    report = await import_lines(client, lines, chunk_size=5)
+
+    *entries, last = report
+    summary = last["summary"]
+    assert {k: summary[k] for k in ("rows", "created", "duplicates", "invalid")} == {
+        "rows": 7, "created": 2, "duplicates": 3, "invalid": 2,
+    }
+    by_line = {e["line"]: e for e in entries}
+    assert sorted(by_line) == [2, 3, 4, 5, 8]
+    assert by_line[2]["status"] == "invalid"
+    assert by_line[3]["status"] == "invalid" and "followers" in by_line[3]["error"]
+    assert by_line[4] == {"line": 4, "email": a, "status": "duplicate", "error": "email ripetuta nel file"}
+    assert by_line[5]["status"] == "duplicate" and by_line[5]["error"] == "email già registrata"
+    assert by_line[8]["status"] == "duplicate" and by_line[8]["email"] == c
+
+    assert set(stored_passwords([a, c, existing["email"]])) == {a, c, existing["email"]}
+    assert stats_snapshot() == rebuilt_stats()
+
+
+@pytest.mark.anyio
+async def test_csv_import(client):
+    a, b = unique_email("csv"), unique_email("csv")
+    lines = [
+        "email,password,main_platform,username,followers,profiles_count",
+        f"{a},pw1,tiktok,csv_a,300000,1",
+        f"{b},pw2,youtube,csv_b,abc,1",
+    ]
+    report = await import_lines(client, lines, fmt="csv")
+    assert report[0]["line"] == 3 and report[0]["status"] == "invalid"
+    assert report[-1]["summary"]["created"] == 1
+    with main.engine.connect() as conn:
+        row = conn.execute(select(main.UserRow.__table__).where(main.UserRow.email == a)).one()
+    assert (row.segment, row.plan_key, row.followers) == ("agency", main.compute_plan_key("agency", 1), 300_000)
+
+
+@pytest.mark.anyio
+async def test_passwords_are_hashed_unless_already_a_valid_hash(client):
+    migrated_hash = main._hash_password("dal-vecchio-sistema", "scrypt")
+    plain, migrated, lookalike = unique_email("plain"), unique_email("hash"), unique_email("fake")
+    await import_lines(client, [
+        json.dumps(record(plain, password="in-chiaro")),
+        json.dumps(record(migrated, password=migrated_hash)),
+        json.dumps(record(lookalike, password="$scrypt$hunter2")),
+    ])
+
+    stored = stored_passwords([plain, migrated, lookalike])
+    assert stored[migrated] == migrated_hash
+    for email in (plain, lookalike):
+        assert stored[email] != "in-chiaro" and stored[email] != "$scrypt$hunter2"
+        assert main.is_password_hash(stored[email])
+
+    for email, password in ((plain, "in-chiaro"), (migrated, "dal-vecchio-sistema"), (lookalike, "$scrypt$hunter2")):
+        r = await client.post("/api/login", json={"email": email, "password": password})
+        assert r.status_code == 200, (email, r.text)
+        r = await client.post("/api/login", json={"email": email, "password": "sbagliata"})
+        assert r.status_code == 400
+
+
+def test_malformed_hashes_are_not_hashes_and_never_verify():
+    good = main._hash_password("pw", "scrypt")
+    assert main.is_password_hash(good)
+    bad = [
+        "$scrypt$hunter2",
+        "$scrypt$ln=14,r=8,p=1$solo-salt",
+        "$scrypt$ln=abc,r=8,p=1$c2FsdA$ZGVyaXZlZGtleWRlcml2ZWRrZXk",
+        "$scrypt$ln=14,r=8$c2FsdA$ZGVyaXZlZGtleWRlcml2ZWRrZXk",
+        "$scrypt$ln=14,r=8,p=1$c2FsdA$!!!",
+        "$argon2id$qualcosa",
+        "$argon2",
+    ]
+    for value in bad:
+        assert not main.is_password_hash(value), value
+    for value in bad[:5]:
+        assert main._verify_password(value, "hunter2", "scrypt") == (False, None), value
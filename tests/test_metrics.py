@@ -0,0 +1,31 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+import main
+
+
+def test_failed_statement_does_not_leave_query_start_behind():
+    with main.engine.connect() as conn:
+        for _ in range(3):
+            with pytest.raises(DBAPIError):
+                conn.execute(text("SELECT * FROM tabella_che_non_esiste"))
+        assert conn.info.get("query_start") == []
+
+        # la query successiva misura solo sé stessa
+        with main.capture_queries() as log:
+            conn.execute(text("SELECT 1"))
+        assert len(log) == 1 and log[0].seconds < 1.0
+        assert conn.info["query_start"] == []
+
+
+@pytest.mark.anyio
+async def test_failed_statement_on_async_engine():
+    try:
+        async with main.async_engine.connect() as conn:
+            with pytest.raises(DBAPIError):
+                await conn.execute(text("SELECT * FROM tabella_che_non_esiste"))
+            await conn.execute(text("SELECT 1"))
+            assert conn.sync_connection.info["query_start"] == []
+    finally:
+        await main.async_engine.dispose()
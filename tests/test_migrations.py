@@ -0,0 +1,152 @@
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import (
+    JSON, Boolean, Column, DateTime, Integer, MetaData, String, Table, Text,
+    create_engine, select, text,
+)
+
+import main
+
+
+def baseline_metadata() -> MetaData:
+    # schema del commit iniziale (prima di qualsiasi migrazione)
+    md = MetaData()
+    Table(
+        "users", md,
+        Column("user_id", String, primary_key=True),
+        Column("email", String, unique=True, nullable=False, index=True),
+        Column("password", String, nullable=False),
+        Column("main_platform", String, nullable=False),
+        Column("username", String, nullable=False),
+        Column("followers", Integer, nullable=False, default=0),
+        Column("profiles_count", Integer, nullable=False, default=1),
+        Column("segment", String, nullable=False),
+        Column("plan", JSON, nullable=False),
+        Column("is_premium", Boolean, nullable=False, default=False),
+        Column("paid_plan", String, nullable=False, default="free"),
+        Column("stripe_customer_id", String, nullable=True),
+        Column("stripe_subscription_id", String, nullable=True),
+        Column("created_at", DateTime(timezone=True), nullable=False),
+        Column("updated_at", DateTime(timezone=True), nullable=False),
+    )
+    Table(
+        "contacts", md,
+        Column("contact_id", String, primary_key=True),
+        Column("name", String, nullable=False),
+        Column("email", String, nullable=False),
+        Column("subject", String, nullable=False),
+        Column("message", Text, nullable=False),
+        Column("created_at", DateTime(timezone=True), nullable=False),
+    )
+    return md
+
+
+@pytest.fixture
+def temp_engine(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    yield eng
+    eng.dispose()
+
+
+def schema_dump(eng) -> list:
+    with eng.connect() as conn:
+        return conn.execute(text("SELECT type, name, sql FROM sqlite_master ORDER BY type, name")).all()
+
+
+def assert_hot_paths_use_indexes(eng) -> None:
+    with eng.connect() as conn:
+        for name, stmt in main.HOT_PATH_QUERIES.items():
+            plan = main.query_plan(conn, stmt)
+            assert "SCAN" not in plan, f"{name}: {plan}"
+            assert main.plan_uses_index(plan), f"{name}: {plan}"
+
+
+def test_fresh_db_migrates_and_hot_paths_use_indexes(temp_engine):
+    applied = main.run_migrations(temp_engine)
+    assert applied == [name for _, name, _ in main.MIGRATIONS]
+    assert main.schema_version(temp_engine) == main.MIGRATIONS[-1][0]
+    assert main.ensure_schema(temp_engine) == []
+    assert_hot_paths_use_indexes(temp_engine)
+
+
+def test_running_migrations_twice_is_a_noop(temp_engine):
+    main.run_migrations(temp_engine)
+    before = schema_dump(temp_engine)
+    with temp_engine.connect() as conn:
+        versions = conn.execute(text("SELECT version, name, applied_at FROM schema_migrations ORDER BY version")).all()
+
+    assert main.run_migrations(temp_engine) == []
+    assert schema_dump(temp_engine) == before
+    with temp_engine.connect() as conn:
+        assert conn.execute(text("SELECT version, name, applied_at FROM schema_migrations ORDER BY version")).all() == versions
+
+    # anche rieseguendo a mano ogni migrazione (devono essere idempotenti)
+    for _, _, fn in main.MIGRATIONS:
+        with temp_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            fn(conn)
+    assert schema_dump(temp_engine) == before
+
+
+def test_baseline_schema_upgrades_cleanly(temp_engine):
+    md = baseline_metadata()
+    md.create_all(temp_engine)
+    now = datetime.now(timezone.utc)
+    users = []
+    for i, (followers, profiles, paid) in enumerate([
+        (500, 1, "free"), (5_000, 1, "emerging"), (50_000, 1, "pro"),
+        (250_000, 1, "agency"), (20_000, 3, "agency"), (1_000, 4, "free"), (300_000, 7, "free"),
+    ]):
+        segment = main.compute_segment(followers, profiles)
+        users.append({
+            "user_id": str(uuid.uuid4()),
+            "email": f"baseline{i}@example.com",
+            "password": "in-chiaro",
+            "main_platform": ["instagram", "tiktok", "YouTube", "myspace"][i % 4],
+            "username": f"b{i}",
+            "followers": followers,
+            "profiles_count": profiles,
+            "segment": segment,
+            "plan": main.compute_plan(segment, profiles),
+            "is_premium": paid != "free",
+            "paid_plan": paid,
+            "stripe_customer_id": f"cus_b{i}" if paid != "free" else None,
+            "stripe_subscription_id": None,
+            "created_at": now,
+            "updated_at": now,
+        })
+    with temp_engine.begin() as conn:
+        conn.execute(md.tables["users"].insert(), users)
+
+    applied = main.run_migrations(temp_engine)
+    assert applied == [name for _, name, _ in main.MIGRATIONS]
+    assert_hot_paths_use_indexes(temp_engine)
+
+    t = main.UserRow.__table__
+    with temp_engine.connect() as conn:
+        rows = {r.user_id: r for r in conn.execute(select(t)).all()}
+        for u in users:
+            assert rows[u["user_id"]].plan_key == main.compute_plan_key(u["segment"], u["profiles_count"])
+        history = conn.execute(select(main.FollowerSnapshotRow.user_id)).scalars().all()
+        assert sorted(history) == sorted(u["user_id"] for u in users)
+        stats = sorted(tuple(r) for r in conn.execute(select(main.UserStatsRow.__table__)).all())
+    expected = {}
+    for u in users:
+        key, mrr = main.stats_state(u["segment"], u["paid_plan"], u["main_platform"], u["followers"],
+                                    main.compute_plan_key(u["segment"], u["profiles_count"]))
+        acc = expected.setdefault(key, [0, 0])
+        acc[0] += 1
+        acc[1] += mrr
+    assert stats == sorted((*k, n, mrr) for k, (n, mrr) in expected.items())
+
+    # dopo l'upgrade l'applicazione scrive come su un DB nuovo (plan=None è
+    # JSON null, come nel signup: su SQLite la colonna resta NOT NULL)
+    with temp_engine.begin() as conn:
+        conn.execute(t.insert(), {
+            "user_id": "nuovo", "email": "nuovo@example.com", "password": "x",
+            "main_platform": "instagram", "username": "nuovo", "followers": 10,
+            "profiles_count": 1, "segment": "casual", "plan_key": "casual", "plan": None,
+            "is_premium": False, "paid_plan": "free", "created_at": now, "updated_at": now,
+        })
+    assert main.run_migrations(temp_engine) == []
@@ -0,0 +1,62 @@
+import pytest
+
+import main
+from conftest import create_user
+from test_dashboard import change_row_elsewhere
+
+
+def test_versions_stay_bounded_with_the_payloads():
+    cache = main.PayloadCache(max_entries=3, ttl_seconds=60)
+    for i in range(100):
+        cache.invalidate(f"u{i}", float(i))
+    assert len(cache._versions) == 3
+
+    for i in range(100):
+        cache.put("media_kit", f"p{i}", 1.0, {"i": i})
+    assert len(cache._entries) == 3
+    assert len(cache._versions) == 3
+    assert set(cache._user_keys) <= set(cache._versions)
+
+
+def test_evicted_version_takes_its_payloads_along():
+    cache = main.PayloadCache(max_entries=2, ttl_seconds=60)
+    cache.put("media_kit", "a", 1.0, "kit-a")
+    cache.invalidate("b", 5.0)
+    cache.invalidate("c", 7.0)  # "a" è l'utente usato meno di recente
+    assert cache.get("media_kit", "a") is None
+    assert cache.get("media_kit", "a", 1.0) is None
+    assert "a" not in cache._user_keys
+
+
+def test_put_older_than_invalidated_version_is_ignored():
+    cache = main.PayloadCache(max_entries=10, ttl_seconds=60)
+    cache.invalidate("a", 10.0)
+    cache.put("media_kit", "a", 9.0, "vecchio")
+    assert cache.get("media_kit", "a", 9.0) is None
+    assert cache.cached_version("media_kit", "a") is None
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path,kind", [("/api/media-kit", "media_kit"), ("/api/profile-tips", "profile_tips")])
+async def test_cached_payload_rechecks_version_in_db(client, path, kind):
+    user = create_user(followers=50_000, paid_plan="pro")
+    params = {"user_id": user["user_id"]}
+    first = await client.get(path, params=params)
+    assert first.status_code == 200
+    assert main.payload_cache.cached_version(kind, user["user_id"]) is not None
+
+    # scrittura da un altro worker: la cache di questo processo non riceve invalidate()
+    change_row_elsewhere(user["user_id"], followers=1_000, segment="casual", plan_key="casual")
+    second = await client.get(path, params=params)
+    assert second.status_code == 200
+    assert second.headers["etag"] != first.headers["etag"]
+    if kind == "media_kit":
+        assert second.json()["followers"] == 1_000
+        assert second.json()["segment"] == "casual"
+    else:
+        assert second.json() != first.json()
+
+    # ora la versione coincide: payload dalla cache, stesso ETag
+    third = await client.get(path, params=params)
+    assert third.headers["etag"] == second.headers["etag"]
+    assert third.content == second.content
@@ -0,0 +1,71 @@
+import uuid
+
+import pytest
+
+import main
+from conftest import create_user, post_stripe_event
+
+
+@pytest.fixture
+def user_params():
+    user = create_user(followers=5_000)
+    return {"user_id": user["user_id"]}
+
+
+@pytest.mark.anyio
+async def test_media_kit_is_one_select(client, user_params):
+    with main.query_budget(select=1, total=1, exact=True):
+        r = await client.get("/api/media-kit", params=user_params)
+    assert r.status_code == 200
+    # cache calda: solo la verifica della versione, per chiave primaria
+    with main.query_budget(select=1, total=1, exact=True, allow_full_scans=False):
+        r = await client.get("/api/media-kit", params=user_params)
+    assert r.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_user_is_one_select(client, user_params):
+    with main.query_budget(select=1, total=1, exact=True):
+        r = await client.get("/api/user", params=user_params)
+    with main.query_budget(select=1, total=1, exact=True, allow_full_scans=False):
+        r = await client.get("/api/user", params=user_params, headers={"if-none-match": r.headers["etag"]})
+    assert r.status_code == 304
+
+
+@pytest.mark.anyio
+async def test_signup_and_login_lookups_use_indexes(client):
+    email = f"budget-{uuid.uuid4().hex}@example.com"
+    with main.query_budget(select=1, allow_full_scans=False):
+        r = await client.post("/api/signup", json={
+            "email": email, "password": "budget-password", "main_platform": "instagram",
+            "username": "budget", "followers": 5_000, "profiles_count": 1,
+        })
+    assert r.status_code == 200
+    with main.query_budget(select=1, allow_full_scans=False):
+        r = await client.post("/api/login", json={"email": email, "password": "budget-password"})
+    assert r.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_stripe_webhook_has_no_full_scans(client, monkeypatch):
+    monkeypatch.setattr(main, "fetch_checkout_price_id", lambda session_id: None)  # niente rete
+    user = create_user(followers=5_000)
+    event = {
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": f"cs_{uuid.uuid4().hex}",
+            "customer_email": user["email"],
+            "customer": f"cus_{uuid.uuid4().hex[:12]}",
+            "amount_total": 490,
+        }},
+    }
+    with main.query_budget(select=0, allow_full_scans=False):
+        r = await post_stripe_event(client, event)
+        assert r.status_code == 200
+        # replay: Stripe ritenta lo stesso evento
+        r = await post_stripe_event(client, event)
+        assert r.json()["duplicate"] is True
+
+    with main.query_budget(allow_full_scans=False):
+        assert await main.drain_stripe_events() >= 1
@@ -0,0 +1,114 @@
+"""Routing delle letture su due file SQLite: primario e replica (copiata a mano)."""
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from sqlalchemy import create_engine, update
+
+import main
+from conftest import create_user
+
+REPLICA_PATH = main.REPLICA_DATABASE_URL.removeprefix("sqlite:///")
+PRIMARY_PATH = main.DATABASE_URL.removeprefix("sqlite:///")
+
+
+async def replicate() -> None:
+    # "replica" = copia consistente del primario in questo istante
+    await main.replica_engine.dispose()
+    src, dst = sqlite3.connect(PRIMARY_PATH), sqlite3.connect(REPLICA_PATH)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+
+
+def on_replica(**values) -> None:
+    eng = create_engine(main.REPLICA_DATABASE_URL)
+    try:
+        with eng.begin() as conn:
+            if "heartbeat" in values:
+                conn.execute(update(main.ReplicaHeartbeatRow).values(beat_at=values["heartbeat"]))
+            if "user_id" in values:
+                conn.execute(
+                    update(main.UserRow).where(main.UserRow.user_id == values["user_id"]).values(username=values["username"])
+                )
+    finally:
+        eng.dispose()
+
+
+async def healthy_replica() -> None:
+    await replicate()
+    await main.check_replica_lag()  # battito sul primario
+    await replicate()
+    await main.check_replica_lag()  # la replica ha il battito di poco fa
+    assert main.replica_state["healthy"]
+
+
+@pytest.fixture
+async def replicated_user(client):
+    user = create_user(followers=5_000)
+    await healthy_replica()
+    # stessa riga, username diverso: dice da quale DB arriva la lettura
+    on_replica(user_id=user["user_id"], username="dalla_replica")
+    return user
+
+
+@pytest.mark.anyio
+async def test_reads_go_to_a_healthy_replica(client, replicated_user):
+    r = await client.get("/api/user", params={"user_id": replicated_user["user_id"]})
+    assert r.json()["username"] == "dalla_replica"
+
+
+@pytest.mark.anyio
+async def test_lagging_replica_falls_back_to_primary(client, replicated_user):
+    on_replica(heartbeat=datetime.now(timezone.utc) - timedelta(seconds=main.REPLICA_MAX_LAG_SECONDS * 4))
+    await main.check_replica_lag()
+    assert not main.replica_state["healthy"]
+    assert main.read_target(replicated_user["user_id"]) == ("primary", "replica_lag")
+
+    r = await client.get("/api/user", params={"user_id": replicated_user["user_id"]})
+    assert r.json()["username"] == replicated_user["username"]
+
+
+@pytest.mark.anyio
+async def test_row_missing_on_replica_is_read_from_primary(client, replicated_user):
+    newer = create_user(followers=500)  # dopo la copia: la replica non ce l'ha
+    r = await client.get("/api/user", params={"user_id": newer["user_id"]})
+    assert r.status_code == 200
+    assert r.json()["username"] == newer["username"]
+
+
+@pytest.mark.anyio
+async def test_read_your_writes_across_workers(client, replicated_user):
+    params = {"user_id": replicated_user["user_id"]}
+    r = await client.post("/api/update-profile", json={**params, "followers": 60_000})
+    assert r.status_code == 200
+    assert main.READ_YOUR_WRITES_COOKIE in r.cookies
+    stamp = r.headers["x-last-write"]
+
+    # la lettura arriva a un altro worker: il marcatore in memoria non c'è
+    main._recent_writes.clear()
+    r = await client.get("/api/user", params=params)
+    assert r.json()["followers"] == 60_000
+
+    # un client API senza cookie ma con l'header
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as other:
+        r = await other.get("/api/user", params=params, headers={"x-last-write": stamp})
+        assert r.json()["followers"] == 60_000
+
+        # senza marcatore si legge la replica, ancora indietro
+        r = await other.get("/api/user", params=params)
+        assert r.json()["followers"] == 5_000
+        assert r.json()["username"] == "dalla_replica"
+
+
+@pytest.mark.anyio
+async def test_expired_or_bogus_write_marker_is_ignored(client, replicated_user):
+    params = {"user_id": replicated_user["user_id"]}
+    old = datetime.now(timezone.utc).timestamp() - main.REPLICA_READ_YOUR_WRITES_SECONDS * 2
+    for marker in (f"{old:.3f}", "non-un-numero", "1e30"):
+        r = await client.get("/api/user", params=params, headers={"x-last-write": marker})
+        assert r.json()["username"] == "dalla_replica"
@@ -0,0 +1,123 @@
+"""Job di ri-segmentazione: ripresa da job_state e update condizionato."""
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import func, select
+
+import main
+from conftest import create_user, rebuilt_stats, stats_snapshot
+
+ADMIN = {"x-admin-token": "admin-test"}
+
+
+def stale_user(prefix: str, followers: int = 50_000) -> dict:
+    # segmento calcolato con soglie "vecchie": il job deve correggerlo
+    uid = f"{prefix}{uuid.uuid4()}"
+    return create_user(user_id=uid, followers=followers, segment="casual", plan_key="casual")
+
+
+def user_row(user_id: str):
+    with main.engine.connect() as conn:
+        return conn.execute(select(main.UserRow.__table__).where(main.UserRow.user_id == user_id)).one()
+
+
+def job_state():
+    with main.engine.connect() as conn:
+        return conn.execute(select(main.JobStateRow.__table__).where(main.JobStateRow.job_name == "resegment")).one_or_none()
+
+
+def total_users() -> int:
+    with main.engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(main.UserRow)).scalar_one()
+
+
+@pytest.fixture(autouse=True)
+def clean_job():
+    with main.engine.begin() as conn:
+        conn.execute(main.JobStateRow.__table__.delete().where(main.JobStateRow.job_name == "resegment"))
+    rebuilt_stats()  # altri test lasciano righe modificate "a mano"
+    yield
+
+
+def test_interrupted_job_resumes_from_saved_cursor():
+    first = stale_user("!")  # prima di ogni uuid: nel primo blocco
+    last = stale_user("~")   # dopo ogni uuid: nell'ultimo blocco
+    for _ in range(8):
+        create_user()        # almeno due blocchi da 5 anche a DB vuoto
+
+    def crash(user_ids):
+        raise RuntimeError("worker riavviato")
+
+    with pytest.raises(RuntimeError):
+        main.resegment_users(batch_size=5, on_changed=crash)
+    state = job_state()
+    assert state.status == "failed" and "riavviato" in state.last_error
+    assert state.cursor is not None and state.processed == 5 and state.changed >= 1
+    assert user_row(first["user_id"]).segment == "pro"  # blocco scritto prima dell'errore
+    assert user_row(last["user_id"]).segment == "casual"
+
+    # nuova esecuzione senza restart: riparte dal cursore, non dall'inizio
+    calls = []
+    result = main.resegment_users(batch_size=5, on_changed=calls.extend)
+    assert first["user_id"] not in calls
+    assert last["user_id"] in calls
+    assert result["status"] == "done" and result["last_error"] is None
+    assert result["processed"] == total_users()  # nessuna riga contata due volte
+    assert user_row(last["user_id"]).segment == "pro"
+    assert stats_snapshot() == rebuilt_stats()
+
+
+def test_saved_cursor_skips_rows_before_it():
+    before, after = stale_user("!"), stale_user("~")
+    with main.engine.begin() as conn:
+        conn.execute(main.JobStateRow.__table__.insert(), {
+            "job_name": "resegment", "status": "running", "cursor": before["user_id"], "processed": 1, "changed": 0,
+        })
+    main.resegment_users(batch_size=50)
+    assert user_row(before["user_id"]).segment == "casual"
+    assert user_row(after["user_id"]).segment == "pro"
+
+    # job concluso: la prossima esecuzione riparte da capo
+    main.resegment_users(batch_size=50)
+    assert user_row(before["user_id"]).segment == "pro"
+    assert job_state().processed == total_users()
+
+
+def test_row_changed_during_the_job_is_not_overwritten(monkeypatch):
+    moving, still = stale_user("!"), stale_user("!")
+    real = main.compute_batch
+
+    def compute_then_user_updates(*args):
+        out = real(*args)
+        # tra lettura e scrittura del job l'utente aggiorna il profilo (come /api/update-profile)
+        with main.db() as s:
+            user = s.get(main.UserRow, moving["user_id"])
+            if user.followers != 300:
+                before = main.user_stats_state(user)
+                user.followers = 300
+                user.segment = main.compute_segment(300, 1)
+                user.plan_key = main.compute_plan_key(user.segment, 1)
+                main.bump_user_stats(s, [(before, main.user_stats_state(user))])
+        return out
+
+    monkeypatch.setattr(main, "compute_batch", compute_then_user_updates)
+    main.resegment_users(batch_size=50)
+
+    row = user_row(moving["user_id"])
+    assert (row.followers, row.segment, row.plan_key) == (300, "casual", "casual")  # non sovrascritto con "pro"
+    assert user_row(still["user_id"]).segment == "pro"
+    assert stats_snapshot() == rebuilt_stats()
+
+
+@pytest.mark.anyio
+async def test_admin_endpoint_runs_the_job(client):
+    user = stale_user("~")
+    assert (await client.get("/api/admin/jobs/resegment", headers=ADMIN)).json() == {"status": "never_run"}
+    r = await client.post("/api/admin/jobs/resegment", params={"batch_size": 100}, headers=ADMIN)
+    assert r.json() == {"status": "started"}
+    await asyncio.wait_for(main._resegment_task, timeout=30)
+    status = (await client.get("/api/admin/jobs/resegment", headers=ADMIN)).json()
+    assert status["status"] == "done" and status["processed"] == total_users()
+    assert user_row(user["user_id"]).segment == "pro"
+    assert (await client.post("/api/admin/jobs/resegment", headers={"x-admin-token": "no"})).status_code == 401
@@ -0,0 +1,105 @@
+"""Letture identiche concorrenti: un solo caricamento, ma mai a scapito del read-your-writes."""
+import asyncio
+import time
+
+import pytest
+
+import main
+from conftest import create_user
+
+
+@pytest.fixture
+def gated_reads(monkeypatch):
+    """read_user che si ferma finché il test non apre il cancello.
+
+    Registra la destinazione di ogni caricamento; legge sempre dal primario
+    (il file della replica nei test è vuoto finché qualcuno non lo copia).
+    """
+    gate = asyncio.Event()
+    loads = []
+
+    async def read_user(user_id):
+        loads.append(main.read_target(user_id)[0])
+        if len(loads) == 1:
+            await gate.wait()
+        async with main.AsyncSessionLocal() as s:
+            return await s.get(main.UserRow, user_id)
+
+    monkeypatch.setattr(main, "read_user", read_user)
+    return gate, loads
+
+
+async def until(predicate) -> None:
+    for _ in range(200):
+        if predicate():
+            return
+        await asyncio.sleep(0.005)
+    raise AssertionError("condizione mai raggiunta")
+
+
+@pytest.mark.anyio
+async def test_concurrent_identical_reads_share_one_load(client, gated_reads):
+    gate, loads = gated_reads
+    user = create_user(followers=40_000)
+    params = {"user_id": user["user_id"]}
+
+    first = asyncio.ensure_future(client.get("/api/user", params=params))
+    await until(lambda: loads)
+    others = [asyncio.ensure_future(client.get("/api/user", params=params)) for _ in range(4)]
+    await until(lambda: main.user_flights.stats()["hot_keys"]
+                and main.user_flights.stats()["hot_keys"][0]["coalesced"] >= 4)
+    gate.set()
+    responses = await asyncio.gather(first, *others)
+
+    assert loads == ["primary"]
+    assert {r.status_code for r in responses} == {200}
+    assert len({r.content for r in responses}) == 1
+    assert {r.headers["etag"] for r in responses} == {responses[0].headers["etag"]}
+    assert main.user_flights.stats()["in_flight"] == 0
+
+
+@pytest.mark.anyio
+async def test_write_marker_does_not_join_a_replica_read(client, gated_reads):
+    gate, loads = gated_reads
+    user = create_user(followers=40_000)
+    params = {"user_id": user["user_id"]}
+    main.replica_state["healthy"] = True
+
+    # lettura "vecchia" in corso sulla replica
+    stale = asyncio.ensure_future(client.get("/api/user", params=params))
+    await until(lambda: loads)
+
+    # lo stesso client ha appena scritto (su un altro worker): header x-last-write
+    fresh = await asyncio.wait_for(
+        client.get("/api/user", params=params, headers={"x-last-write": f"{time.time():.3f}"}), timeout=5
+    )
+    assert fresh.status_code == 200
+    assert loads == ["replica", "primary"]  # non ha aspettato il leader sulla replica
+    assert not stale.done()
+
+    gate.set()
+    assert (await stale).status_code == 200
+
+
+@pytest.mark.anyio
+async def test_primary_reads_do_not_join_replica_leader():
+    main.replica_state["healthy"] = True
+    gate = asyncio.Event()
+    calls = []
+
+    async def load(tag):
+        calls.append(tag)
+        await gate.wait()
+        return tag
+
+    leader = asyncio.ensure_future(main.user_flights.do("user", "u-target", lambda: load("replica")))
+    await until(lambda: calls)
+    # la replica va in ritardo: chi arriva ora deve leggere il primario
+    main.replica_state["healthy"] = False
+    follower = asyncio.ensure_future(main.user_flights.do("user", "u-target", lambda: load("primary")))
+    try:
+        await until(lambda: len(calls) == 2)
+    finally:
+        gate.set()
+    assert await leader == "replica"
+    assert await follower == "primary"
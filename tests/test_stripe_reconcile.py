@@ -0,0 +1,164 @@
+"""Riconciliazione periodica contro lo stub Stripe (tests/stripe_stub.py)."""
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import delete, select
+
+import main
+from conftest import create_user, rebuilt_stats, stats_snapshot
+
+PRICES = {"emerging": ("price_test_emerging_m", 490), "pro": ("price_test_pro_m", 990)}
+LAST_MONTH = datetime.now(timezone.utc) - timedelta(days=30)
+
+
+def subscription(customer: str, plan: str, status: str = "active", age_days: int = 10,
+                 price: str = "") -> dict:
+    price_id, amount = PRICES[plan]
+    sub_id = f"sub_{uuid.uuid4().hex[:14]}"
+    return {
+        "id": sub_id, "object": "subscription", "customer": customer, "email": "", "status": status,
+        "created": int(time.time()) - age_days * 86400,
+        "items": {"object": "list", "data": [{
+            "id": f"si_{sub_id}", "object": "subscription_item", "quantity": 1,
+            "price": {"id": price or price_id, "object": "price", "unit_amount": amount},
+        }]},
+    }
+
+
+def user_rows(user_ids) -> dict:
+    t = main.UserRow.__table__
+    with main.engine.connect() as conn:
+        return {r.user_id: r for r in conn.execute(select(t).where(t.c.user_id.in_(list(user_ids)))).all()}
+
+
+def stats_counts(snapshot: list) -> Counter:
+    counts = Counter()
+    for *key, users, mrr in snapshot:
+        counts[(*key, "users")] += users
+        counts[(*key, "mrr")] += mrr
+    return counts
+
+
+@pytest.fixture
+def drifted(stripe_stub):
+    # abbonamenti lasciati da altri test: la riconciliazione li cancellerebbe
+    with main.engine.begin() as conn:
+        conn.execute(delete(main.UserRow).where(main.UserRow.stripe_subscription_id.is_not(None)))
+    rebuilt_stats()
+
+    def customer() -> str:
+        return f"cus_{uuid.uuid4().hex[:12]}"
+
+    users, subs, expected = {}, [], {}
+
+    def add(name: str, user_fields: dict, stripe_subs: list, want: dict) -> None:
+        user = create_user(followers=50_000, created_at=LAST_MONTH, **user_fields)
+        for s in stripe_subs:
+            s["email"] = user["email"]
+        users[name] = user
+        subs.extend(stripe_subs)
+        expected[name] = want
+
+    c = customer()
+    s = subscription(c, "pro")
+    add("in_sync", dict(paid_plan="pro", stripe_customer_id=c, stripe_subscription_id=s["id"], updated_at=LAST_MONTH),
+        [s], {"paid_plan": "pro", "stripe_customer_id": c, "stripe_subscription_id": s["id"]})
+
+    c = customer()
+    s = subscription(c, "pro", price="price_legacy_pro")  # price sconosciuto: piano dall'importo
+    add("in_sync_legacy_price", dict(paid_plan="pro", stripe_customer_id=c, stripe_subscription_id=s["id"], updated_at=LAST_MONTH),
+        [s], {"paid_plan": "pro", "stripe_customer_id": c, "stripe_subscription_id": s["id"]})
+
+    c = customer()
+    old, new = subscription(c, "emerging", age_days=40), subscription(c, "pro", age_days=2)
+    add("plan_drift", dict(paid_plan="emerging", stripe_customer_id=c, stripe_subscription_id=old["id"], updated_at=LAST_MONTH),
+        [old, new], {"paid_plan": "pro", "stripe_customer_id": c, "stripe_subscription_id": new["id"]})
+
+    c = customer()
+    s = subscription(c, "emerging")
+    add("checkout_lost", dict(updated_at=LAST_MONTH),
+        [s], {"paid_plan": "emerging", "stripe_customer_id": c, "stripe_subscription_id": s["id"]})
+
+    c = customer()
+    s = subscription(c, "pro", status="canceled")
+    add("deletion_lost", dict(paid_plan="pro", stripe_customer_id=c, stripe_subscription_id=s["id"], updated_at=LAST_MONTH),
+        [s], {"paid_plan": "free", "stripe_customer_id": c, "stripe_subscription_id": None})
+
+    c = customer()
+    s = subscription(c, "pro", status="incomplete_expired")
+    add("touched_during_job", dict(paid_plan="pro", stripe_customer_id=c, stripe_subscription_id=s["id"],
+                                   updated_at=datetime.now(timezone.utc) + timedelta(hours=1)),
+        [s], {"paid_plan": "pro", "stripe_customer_id": c, "stripe_subscription_id": s["id"]})
+
+    stripe_stub.load(subs)
+    return users, expected
+
+
+def test_dry_run_reports_without_writing(drifted):
+    users, _ = drifted
+    before = user_rows(u["user_id"] for u in users.values())
+    report = main.reconcile_stripe(dry_run=True, concurrency=2, rps=1000)
+    assert report["corrections"] == {"linked": 1, "updated": 1, "canceled": 1, "skipped_recent": 1}
+    assert report["applied"] == 0
+    changed = {c["user_id"]: c["to"] for c in report["changes"]}
+    assert changed == {
+        users["plan_drift"]["user_id"]: "pro",
+        users["checkout_lost"]["user_id"]: "emerging",
+        users["deletion_lost"]["user_id"]: "free",
+    }
+    assert user_rows(before) == before
+
+
+def test_reconcile_repairs_drift_and_leaves_matching_rows(drifted):
+    users, expected = drifted
+    ids = {name: u["user_id"] for name, u in users.items()}
+    before = user_rows(ids.values())
+    stats_before = stats_snapshot()
+
+    report = main.reconcile_stripe(concurrency=2, rps=1000)
+    assert report["corrections"] == {"linked": 1, "updated": 1, "canceled": 1, "skipped_recent": 1}
+    assert report["applied"] == 3
+
+    after = user_rows(ids.values())
+    for name, uid in ids.items():
+        r = after[uid]
+        got = {"paid_plan": r.paid_plan, "stripe_customer_id": r.stripe_customer_id,
+               "stripe_subscription_id": r.stripe_subscription_id}
+        assert got == expected[name], name
+        assert bool(r.is_premium) == (r.paid_plan != "free"), name
+    for name in ("in_sync", "in_sync_legacy_price", "touched_during_job"):
+        assert after[ids[name]] == before[ids[name]], name  # riga intatta, updated_at compreso
+
+    # user_stats: esattamente il delta (prima -> dopo) di ogni riga corretta
+    repaired = ("plan_drift", "checkout_lost", "deletion_lost")
+    want = Counter()
+    for d in main.stats_delta_rows(
+        (main.user_stats_state(main.UserRow(**before[ids[n]]._asdict())),
+         main.user_stats_state(main.UserRow(**after[ids[n]]._asdict())))
+        for n in repaired
+    ):
+        key = (d["segment"], d["paid_plan"], d["main_platform"], d["follower_bucket"])
+        want[(*key, "users")] += d["users"]
+        want[(*key, "mrr")] += d["mrr_cents"]
+    delta = stats_counts(stats_snapshot())
+    delta.subtract(stats_counts(stats_before))
+    assert {k: v for k, v in delta.items() if v} == {k: v for k, v in want.items() if v}
+    assert stats_snapshot() == rebuilt_stats()
+
+    again = main.reconcile_stripe(concurrency=2, rps=1000)
+    assert again["applied"] == 0
+    assert again["corrections"] == {"linked": 0, "updated": 0, "canceled": 0, "skipped_recent": 1}
+
+
+def test_rate_limited_listing_still_completes(drifted, stripe_stub):
+    stripe_stub.rps = 2.0
+    stripe_stub._tokens = 0.0
+    try:
+        report = main.reconcile_stripe(dry_run=True, concurrency=4, rps=1000)
+    finally:
+        stripe_stub.rps = 1000.0
+    assert stripe_stub.stats["rate_limited"] > 0
+    assert report["corrections"] == {"linked": 1, "updated": 1, "canceled": 1, "skipped_recent": 1}
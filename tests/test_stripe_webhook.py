@@ -0,0 +1,202 @@
+"""Webhook Stripe firmati -> coda stripe_events -> worker (drain_stripe_events)."""
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select, update
+
+import main
+from conftest import create_user, post_stripe_event
+
+
+@pytest.fixture(autouse=True)
+def line_items(monkeypatch):
+    # line_items del checkout senza rete: il price del piano Pro
+    monkeypatch.setattr(main, "fetch_checkout_price_id", lambda session_id: "price_test_pro_m")
+
+
+def checkout_event(email: str) -> dict:
+    return {
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": f"cs_{uuid.uuid4().hex}",
+            "customer_email": email,
+            "customer": f"cus_{uuid.uuid4().hex[:12]}",
+            "subscription": f"sub_{uuid.uuid4().hex[:12]}",
+            "amount_total": 990,
+        }},
+    }
+
+
+def queue_rows(event_id: str) -> list:
+    with main.engine.connect() as conn:
+        return conn.execute(select(main.StripeEventRow.__table__).where(main.StripeEventRow.event_id == event_id)).all()
+
+
+def user_row(user_id: str):
+    with main.engine.connect() as conn:
+        return conn.execute(select(main.UserRow.__table__).where(main.UserRow.user_id == user_id)).one()
+
+
+async def drain_until_empty() -> None:
+    while await main.drain_stripe_events():
+        pass
+
+
+def make_due(event_id: str) -> None:
+    # salta l'attesa del backoff
+    with main.engine.begin() as conn:
+        conn.execute(
+            update(main.StripeEventRow)
+            .where(main.StripeEventRow.event_id == event_id)
+            .values(next_attempt_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+        )
+
+
+@pytest.mark.anyio
+async def test_duplicate_event_ids_are_queued_once(client):
+    user = create_user(followers=50_000)
+    event = checkout_event(user["email"])
+
+    first = await post_stripe_event(client, event)
+    second = await post_stripe_event(client, event)
+    assert first.json() == {"status": "ok", "duplicate": False}
+    assert second.json() == {"status": "ok", "duplicate": True}
+    [row] = queue_rows(event["id"])
+    assert row.status == "pending" and row.attempts == 0
+
+    await drain_until_empty()
+    [row] = queue_rows(event["id"])
+    assert row.status == "done" and row.last_error is None
+    u = user_row(user["user_id"])
+    assert u.paid_plan == "pro" and u.is_premium
+    assert u.stripe_customer_id == event["data"]["object"]["customer"]
+    assert u.stripe_subscription_id == event["data"]["object"]["subscription"]
+
+
+@pytest.mark.anyio
+async def test_bad_signature_is_rejected_and_not_queued(client):
+    event = checkout_event("nessuno@example.com")
+    body = json.dumps(event)
+    r = await client.post("/stripe/webhook", content=body, headers={"stripe-signature": "t=1,v1=deadbeef"})
+    assert r.status_code == 400
+    assert queue_rows(event["id"]) == []
+
+
+@pytest.mark.anyio
+async def test_handler_failure_is_retried(client, monkeypatch):
+    user = create_user(followers=50_000)
+    event = checkout_event(user["email"])
+    await post_stripe_event(client, event)
+
+    real = main.infer_plan_from_price_id
+    calls = {"n": 0}
+
+    def flaky(*args):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise RuntimeError("DB momentaneamente non disponibile")
+        return real(*args)
+
+    monkeypatch.setattr(main, "infer_plan_from_price_id", flaky)
+
+    await main.drain_stripe_events()
+    [row] = queue_rows(event["id"])
+    assert row.status == "pending" and row.attempts == 1
+    assert "momentaneamente" in row.last_error
+    assert user_row(user["user_id"]).paid_plan == "free"  # niente scrittura a metà
+
+    make_due(event["id"])
+    await drain_until_empty()
+    [row] = queue_rows(event["id"])
+    assert row.status == "done" and row.attempts == 1 and row.last_error is None
+    assert user_row(user["user_id"]).paid_plan == "pro"
+
+
+@pytest.mark.anyio
+async def test_event_failing_every_time_ends_up_failed(client, monkeypatch):
+    user = create_user(followers=50_000)
+    event = checkout_event(user["email"])
+    await post_stripe_event(client, event)
+
+    def broken(*args):
+        raise RuntimeError("sempre rotto")
+
+    monkeypatch.setattr(main, "infer_plan_from_price_id", broken)
+    for _ in range(main.STRIPE_EVENTS_MAX_ATTEMPTS + 2):
+        make_due(event["id"])
+        await main.drain_stripe_events()
+    [row] = queue_rows(event["id"])
+    assert row.status == "failed" and row.attempts == main.STRIPE_EVENTS_MAX_ATTEMPTS
+    assert user_row(user["user_id"]).paid_plan == "free"
+
+
+@pytest.mark.anyio
+async def test_replay_of_processed_event_is_not_applied_again(client):
+    user = create_user(followers=50_000)
+    event = checkout_event(user["email"])
+    await post_stripe_event(client, event)
+    await drain_until_empty()
+    assert user_row(user["user_id"]).paid_plan == "pro"
+
+    # dopo l'evento l'utente torna free: il replay non deve riportarlo a pro
+    r = await client.post("/api/update-plan", json={"user_id": user["user_id"], "new_plan": "free"})
+    assert r.status_code == 200
+    [done] = queue_rows(event["id"])
+
+    r = await post_stripe_event(client, event)
+    assert r.json()["duplicate"] is True
+    await drain_until_empty()
+    assert queue_rows(event["id"]) == [done]
+    assert user_row(user["user_id"]).paid_plan == "free"
+
+
+@pytest.mark.anyio
+async def test_failed_event_waits_for_backoff(client, monkeypatch):
+    user, other = create_user(followers=50_000), create_user(followers=50_000)
+    failing, ok = checkout_event(user["email"]), checkout_event(other["email"])
+    await post_stripe_event(client, failing)
+
+    real = main.infer_plan_from_price_id
+    broken = {"on": True}
+
+    def flaky(*args):
+        if broken["on"]:
+            raise RuntimeError("Stripe giù")
+        return real(*args)
+
+    monkeypatch.setattr(main, "infer_plan_from_price_id", flaky)
+
+    before = datetime.now(timezone.utc)
+    assert await main.drain_stripe_events() == 1
+    [row] = queue_rows(failing["id"])
+    assert row.attempts == 1
+    wait = (main.as_utc(row.next_attempt_at) - before).total_seconds()
+    assert main.stripe_event_backoff(1) - 1 <= wait <= main.stripe_event_backoff(1) + 1
+
+    # subito dopo non viene ripreso (niente tentativi bruciati, niente giri a vuoto)
+    assert await main.drain_stripe_events() == 0
+    assert queue_rows(failing["id"])[0].attempts == 1
+
+    # gli eventi dietro non restano bloccati
+    broken["on"] = False
+    await post_stripe_event(client, ok)
+    assert await main.drain_stripe_events() == 1
+    assert queue_rows(ok["id"])[0].status == "done"
+    assert queue_rows(failing["id"])[0].status == "pending"
+
+    make_due(failing["id"])
+    await drain_until_empty()
+    [row] = queue_rows(failing["id"])
+    assert row.status == "done" and row.attempts == 1
+    assert user_row(user["user_id"]).paid_plan == "pro"
+
+
+def test_backoff_grows_and_is_capped():
+    delays = [main.stripe_event_backoff(n) for n in range(1, 30)]
+    assert delays[0] == main.STRIPE_EVENTS_BACKOFF_BASE_SECONDS
+    assert delays[1] == 2 * delays[0]
+    assert delays == sorted(delays)
+    assert delays[-1] == main.STRIPE_EVENTS_BACKOFF_MAX_SECONDS
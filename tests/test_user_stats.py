@@ -0,0 +1,60 @@
+import asyncio
+import uuid
+
+import pytest
+
+import main
+from conftest import create_user, rebuilt_stats, stats_snapshot
+
+FOLLOWERS = [500, 5_000, 50_000, 500_000, 1_500, 9_999, 10_000, 199_999]
+PLANS = ["free", "emerging", "pro", "agency"]
+
+
+def checkout_event(email: str, amount_cents: int) -> dict:
+    return {
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": f"cs_{uuid.uuid4().hex}",
+            "customer_details": {"email": email},
+            "customer": "cus_interleaved",
+            "subscription": f"sub_{uuid.uuid4().hex}",
+            "amount_total": amount_cents,
+        }},
+    }
+
+
+def subscription_deleted_event(customer_id: str) -> dict:
+    return {
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": "customer.subscription.deleted",
+        "data": {"object": {"customer": customer_id}},
+    }
+
+
+@pytest.mark.anyio
+async def test_interleaved_updates_keep_user_stats_exact(client, monkeypatch):
+    monkeypatch.setattr(main, "fetch_checkout_price_id", lambda session_id: None)  # niente rete
+    rebuilt_stats()  # altri test cambiano righe senza delta: si riparte dal vero
+    user = create_user(followers=5_000, stripe_customer_id="cus_interleaved")
+    params = {"user_id": user["user_id"]}
+
+    calls = []
+    for i in range(24):
+        if i % 4 == 0:
+            calls.append(client.post("/api/update-profile", json={**params, "followers": FOLLOWERS[i % len(FOLLOWERS)]}))
+        elif i % 4 == 1:
+            calls.append(client.post("/api/update-plan", json={**params, "new_plan": PLANS[i % len(PLANS)]}))
+        elif i % 4 == 2:
+            calls.append(main.apply_stripe_event(checkout_event(user["email"], 1_990)))
+        else:
+            calls.append(main.apply_stripe_event(subscription_deleted_event("cus_interleaved")))
+        calls.append(client.post("/api/update-profile", json={**params, "followers": FOLLOWERS[(i * 3) % len(FOLLOWERS)], "profiles_count": 1 + i % 2}))
+
+    results = await asyncio.gather(*calls)
+    for r in results:
+        if r is not None:
+            assert r.status_code == 200
+
+    incremental = stats_snapshot()
+    assert incremental == rebuilt_stats()
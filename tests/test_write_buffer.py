@@ -0,0 +1,110 @@
+"""Group commit dei contatti (WriteBuffer) con il worker avviato, come sotto lifespan."""
+import asyncio
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+
+import main
+
+
+@pytest.fixture
+async def running_buffer(client, monkeypatch):
+    # la suite gira con WRITE_BUFFER_ENABLED=0: qui il worker si avvia a mano
+    buf = main.append_buffer
+    monkeypatch.setattr(buf, "max_delay", 0.2)
+    monkeypatch.setattr(buf, "stats", {k: 0 for k in buf.stats})
+    main.reset_worker_events()
+    task = buf.start()
+    yield buf, task
+    main.workers_stop.set()
+    await asyncio.gather(task, return_exceptions=True)
+    main.reset_worker_events()
+
+
+@pytest.fixture
+def commits():
+    count = {"n": 0}
+
+    def on_commit(conn):
+        count["n"] += 1
+
+    event.listen(main.async_engine.sync_engine, "commit", on_commit)
+    yield count
+    event.remove(main.async_engine.sync_engine, "commit", on_commit)
+
+
+def contact(i: int) -> dict:
+    return {"name": f"Nome {i}", "email": f"gc{i}@example.com", "subject": f"gc-{uuid.uuid4().hex[:8]}", "message": "Ciao"}
+
+
+def stored(contact_ids) -> dict:
+    with main.engine.connect() as conn:
+        rows = conn.execute(
+            select(main.ContactRow.contact_id, main.EmailOutboxRow.outbox_id)
+            .join(main.EmailOutboxRow, main.EmailOutboxRow.contact_id == main.ContactRow.contact_id, isouter=True)
+            .where(main.ContactRow.contact_id.in_(list(contact_ids)))
+        ).all()
+    return dict(rows)
+
+
+@pytest.mark.anyio
+async def test_concurrent_contacts_share_transactions(client, running_buffer, commits):
+    buf, _ = running_buffer
+    n = 20
+    responses = await asyncio.gather(*(client.post("/api/contact", json=contact(i)) for i in range(n)))
+    assert {r.status_code for r in responses} == {200}
+
+    ids = [r.json()["contact_id"] for r in responses]
+    rows = stored(ids)
+    assert set(rows) == set(ids)
+    assert all(rows.values())  # contatto ed email in coda nella stessa transazione
+    assert buf.stats["items"] == n and buf.stats["direct"] == 0
+    assert buf.stats["rows"] == 2 * n
+    assert 1 <= commits["n"] == buf.stats["batches"] < n
+
+
+@pytest.mark.anyio
+async def test_one_bad_item_does_not_fail_the_batch(client, running_buffer):
+    buf, _ = running_buffer
+    now = datetime.now(timezone.utc)
+    bad = [(main.ContactRow.__table__, {
+        "contact_id": str(uuid.uuid4()), "name": None, "email": "x@example.com",
+        "subject": "rotto", "message": "name NULL", "created_at": now,
+    })]
+
+    results = await asyncio.gather(
+        *(client.post("/api/contact", json=contact(i)) for i in range(5)),
+        buf.add(bad),
+        *(client.post("/api/contact", json=contact(i)) for i in range(5, 10)),
+        return_exceptions=True,
+    )
+    responses, failure = results[:5] + results[6:], results[5]
+    assert isinstance(failure, IntegrityError)
+    assert {r.status_code for r in responses} == {200}
+    ids = [r.json()["contact_id"] for r in responses]
+    assert set(stored(ids)) == set(ids)
+    assert stored([bad[0][1]["contact_id"]]) == {}
+    assert buf.stats["retries"] >= 1 and buf.stats["failed"] == 1
+
+
+@pytest.mark.anyio
+async def test_pending_writes_fail_when_the_worker_stops(client, running_buffer, monkeypatch):
+    buf, task = running_buffer
+    monkeypatch.setattr(buf, "max_delay", 30.0)  # il batch resta aperto
+    pending = asyncio.ensure_future(client.post("/api/contact", json=contact(0)))
+    for _ in range(200):
+        if buf._pending:
+            break
+        await asyncio.sleep(0.005)
+    task.cancel()
+    with pytest.raises(RuntimeError, match="write buffer fermato"):
+        await pending
+
+    # a worker fermo si scrive direttamente
+    r = await client.post("/api/contact", json=contact(1))
+    assert r.status_code == 200
+    assert buf.stats["direct"] == 1
+    assert set(stored([r.json()["contact_id"]])) == {r.json()["contact_id"]}